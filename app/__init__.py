@@ -11,12 +11,19 @@ from flask import Flask, render_template
 from flask_admin import Admin
 
 # Import SQLAlchemy
+import sqlite3
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
 
 # Global variables
 EXPERT_ADD_ON = False
 OWN_BRAND = False
 WALKTHROUGH = False
+TWO_STAGE_RETRIEVAL = True #only score docs found in the positional index
+ROBOTS_CACHE_TTL = 86400 #seconds before a site's robots.txt is fetched again
+ROBOTS_CACHE_SIZE = 10000 #max number of sites in the robots.txt cache
+PARSE_PROCESSES = max(0, os.cpu_count() - 1) #processes parsing documents during indexing, 0 to parse in the fetching threads
 
 # Get paths to SentencePiece model and vocab
 LANG = sys.argv[1] #default language for the installation
@@ -54,11 +61,25 @@ app.config.from_object('config')
 db = SQLAlchemy(app)
 
 
+@event.listens_for(Engine, "connect")
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    '''Apply the SQLITE_PRAGMAS of the configuration to each new connection.'''
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        cursor = dbapi_connection.cursor()
+        for pragma, value in app.config.get('SQLITE_PRAGMAS', {}).items():
+            cursor.execute('PRAGMA %s = %s' % (pragma, value))
+        cursor.close()
+
+
 # Load static multilingual info
-from app.multilinguality import read_language_codes, read_stopwords
+from app.multilinguality import read_language_codes, read_stopwords, get_installed_languages
 
 LANGUAGE_CODES = read_language_codes()
 STOPWORDS = read_stopwords(LANGUAGE_CODES[LANG].lower())
+installed_languages = get_installed_languages()
+
+from app.indexer import parser_settings
+parser_settings.configure(LANG, SPM_DEFAULT_MODEL_PATH, LANGUAGE_CODES, installed_languages)
 
 
 # Import a module / component using its blueprint handler variable (mod_auth)
@@ -85,6 +106,8 @@ app.register_blueprint(settings_module)
 # db.drop_all()
 with app.app_context():
     db.create_all()
+    from app.api.models import migrate_db
+    migrate_db()
 
 from flask_admin.contrib.sqla import ModelView
 from app.api.models import Pods, Urls
@@ -100,7 +123,7 @@ admin = Admin(app, name='PeARS DB', template_mode='bootstrap3')
 
 class UrlsModelView(ModelView):
     list_template = 'admin/pears_list.html'
-    column_exclude_list = ['vector','snippet','date_created','date_modified']
+    column_exclude_list = ['vector','snippet','date_created','date_modified','etag','last_modified','content_hash','row_id']
     column_searchable_list = ['url', 'title', 'doctype', 'notes', 'pod']
     column_editable_list = ['notes']
     can_edit = True
@@ -8,11 +8,9 @@ from flask import Blueprint, jsonify, request
 import numpy as np
 from scipy.sparse import csr_matrix, vstack, save_npz, load_npz
 from os.path import dirname, join, realpath, basename
-from app.utils_db import pod_from_file
 from app.api.models import Urls, Pods
 from app import db, vocab, VEC_SIZE
-from app.indexer.posix import load_posix, dump_posix
-from os import remove
+from app.indexer.deletion import delete_urls, remove_pod
 
 # Define the blueprint:
 api = Blueprint('api', __name__, url_prefix='/api')
@@ -34,23 +32,9 @@ def return_pod(pod):
 @api.route('/pods/delete', methods=["GET","POST"])
 def return_pod_delete(pod_name):
     print("Unsubscribing pod...", pod_name)
-    pod = db.session.query(Pods).filter_by(name=pod_name).first()
-    lang = pod.language
-    urls = db.session.query(Urls).filter_by(pod=pod_name).all()
-    if urls is not None:
-        for u in urls:
-            db.session.delete(u)
-            db.session.commit()
-    print("Removing CSR matrix")
-    remove(join(pod_dir,pod_name+'.npz'))
-    print("Removing positional index")
-    remove(join(pod_dir,pod_name+'.pos'))
-    print("Reverting summary to 0")
-    pod_from_file(pod_name, lang, np.zeros(VEC_SIZE))
-    db.session.delete(pod)
-    db.session.commit()
-
-
+    for status, num_deleted, total in remove_pod(pod_name, keep_entry=False):
+        print(status, num_deleted, "/", total, "URLs deleted")
+    return "Deleted pod "+pod_name
 
 
 @api.route('/urls/')
@@ -62,47 +46,10 @@ def return_urls():
 def return_url_delete(path):
     #path = request.args.get('path')
     u = db.session.query(Urls).filter_by(url=path).first()
-    pod = u.pod
-    vid = int(u.vector)
-    print(path, vid,pod)
-
-    #Remove document row from .npz matrix
-    pod_m = load_npz(join(pod_dir,pod+'.npz'))
-    m1 = pod_m[:vid]
-    m2 = pod_m[vid+1:]
-    pod_m = vstack((m1,m2)) 
-    save_npz(join(pod_dir,pod+'.npz'),pod_m)
-
-    #Correct indices in DB
-    urls = db.session.query(Urls).filter_by(pod=pod).all()
-    for url in urls:
-        if int(url.vector) > vid:
-            url.vector = str(int(url.vector)-1) #Decrease ID now that matrix row has gone
-        db.session.add(url)
-        db.session.commit()
-   
-    #Remove doc from positional index
-    posindex = load_posix(pod)
-    new_posindex = []
-    for token in vocab:
-        token_id = vocab[token]
-        tmp = {}
-        for doc_id, posidx in posindex[token_id].items():
-            if doc_id != str(vid):
-                tmp[doc_id] = posidx
-            #else:
-            #    print("Deleting doc",doc_id,"from token",token,token_id)
-        new_posindex.append(tmp)
-    dump_posix(new_posindex,pod)
-
-    #Recompute pod summary
-    podsum = np.sum(pod_m, axis=0)
-    p = db.session.query(Pods).filter_by(name=pod).first()
-    pod_from_file(pod, p.language, podsum)
-    db.session.delete(u)
-    db.session.commit()
-    #except:
-    #    return "Deletion failed"
+    vid = u.vector
+    print(path, vid, u.pod)
+    #Mark the row deleted, the pod is compacted once enough rows are
+    delete_urls([path])
     return "Deleted document with vector id"+str(vid)
 
 
@@ -2,27 +2,13 @@
 #
 # SPDX-License-Identifier: AGPL-3.0-only
 
-from app import db
+from app import db, installed_languages
 from app.utils import convert_to_array
 import numpy as np
+from sqlalchemy import exc
 import configparser
 import joblib
-from glob import glob
 from os.path import isdir, exists
-import sentencepiece as spm
-
-sp = spm.SentencePieceProcessor()
-
-def get_installed_languages():
-    installed_languages = []
-    language_paths = glob('./app/api/models/*/')
-    for p in language_paths:
-        lang = p[:-1].split('/')[-1]
-        installed_languages.append(lang)
-    print("Installed languages:",installed_languages)
-    return installed_languages
-
-installed_languages = get_installed_languages()
 
 
 # Define a base model for other database tables to inherit
@@ -40,7 +26,7 @@ class Base(db.Model):
 
 class Urls(Base):
     id = db.Column(db.Integer, primary_key=True)
-    url = db.Column(db.String(1000))
+    url = db.Column(db.String(1000), unique=True, index=True)
     title = db.Column(db.String(1000))
     vector = db.Column(db.String(1000))
     snippet = db.Column(db.String(1000))
@@ -48,6 +34,13 @@ class Urls(Base):
     pod = db.Column(db.String(1000))
     notes = db.Column(db.String(1000))
     img = db.Column(db.String(1000))
+    etag = db.Column(db.String(1000)) #validators and text hash of the last fetch, for refreshes
+    last_modified = db.Column(db.String(1000))
+    content_hash = db.Column(db.String(64))
+    row_id = db.Column(db.Integer) #row in the pod matrix, same as vector but as an integer
+
+    # also serves lookups by pod alone
+    __table_args__ = (db.Index('ix_urls_pod_row_id', 'pod', 'row_id'),)
 
     def __init__(self,
                  url=None,
@@ -120,3 +113,42 @@ class Pods(Base):
             'registered': self.registered
         }
 
+
+def add_missing_columns():
+    '''db.create_all() does not alter existing tables: add the columns
+    introduced since a database was created.'''
+    inspector = db.inspect(db.engine)
+    for table in (Urls, Pods):
+        existing = [c['name'] for c in inspector.get_columns(table.__tablename__)]
+        for column in table.__table__.columns:
+            if column.name not in existing:
+                print("Adding column", column.name, "to table", table.__tablename__)
+                column_type = column.type.compile(dialect=db.engine.dialect)
+                db.session.execute(db.text('ALTER TABLE %s ADD COLUMN %s %s' % (table.__tablename__, column.name, column_type)))
+    db.session.commit()
+
+
+def add_missing_indexes():
+    '''Create the indexes introduced since a database was created. If
+    a database holds duplicate URLs, the URL index is not unique.'''
+    inspector = db.inspect(db.engine)
+    for table in (Urls, Pods):
+        existing = [i['name'] for i in inspector.get_indexes(table.__tablename__)]
+        for index in table.__table__.indexes:
+            if index.name not in existing:
+                print("Adding index", index.name, "to table", table.__tablename__)
+                try:
+                    index.create(db.engine)
+                except exc.IntegrityError:
+                    columns = ', '.join(c.name for c in index.columns)
+                    print("WARNING: duplicate values in", table.__tablename__, "(", columns, "), index", index.name, "is not unique")
+                    db.session.execute(db.text('CREATE INDEX %s ON %s (%s)' % (index.name, table.__tablename__, columns)))
+                    db.session.commit()
+
+
+def migrate_db():
+    '''Bring a database created by an older version up to date.'''
+    add_missing_columns()
+    db.session.execute(db.text("UPDATE urls SET row_id = CAST(vector AS INTEGER) WHERE row_id IS NULL AND vector != '' AND vector NOT GLOB '*[^0-9]*'"))
+    db.session.commit()
+    add_missing_indexes()
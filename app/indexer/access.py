@@ -1,58 +1,189 @@
 from urllib.parse import urlparse
-from os.path import join
-import requests
+from os.path import join, dirname, realpath, isfile
+from collections import OrderedDict
+from app import ROBOTS_CACHE_TTL, ROBOTS_CACHE_SIZE
+from app.indexer import fetcher
+import threading
+import atexit
+import json
+import time
 import sys
+import os
 import re
 
-def robotcheck(url):
+dir_path = dirname(dirname(realpath(__file__)))
+robots_cache_path = join(dir_path,'static','robots_cache.json')
+
+_robots = OrderedDict() #domain -> (fetch time, rules), least recently used first
+_robots_lock = threading.Lock()
+_robots_fetching = {} #domain -> lock held while its robots.txt is fetched
+_robots_loaded = False
+_robots_saved = {'dirty': False, 'time': 0.0}
+
+ROBOTS_SAVE_INTERVAL = 60 #seconds between writes of the robots cache to disk
+INDEXED_TYPES = ('text/html', 'application/pdf') #content types downloaded for indexing
+MAX_BODY_SIZE = 20000000 #bytes of a page or PDF downloaded at most
+
+
+def parse_robots(content):
+    '''Allow/Disallow rules of the "User-agent: *" group(s)
+    of a robots.txt file, as (allowed, path pattern) pairs.'''
+    rules = []
+    applies = False
+    in_rules = False
+    for l in content.splitlines():
+        l = l.split('#')[0].strip()
+        if ':' not in l:
+            continue
+        field, value = [x.strip() for x in l.split(':', 1)]
+        field = field.lower()
+        if field == 'user-agent':
+            if in_rules: #a new group starts
+                applies = False
+                in_rules = False
+            if value == '*':
+                applies = True
+        elif field in ('allow', 'disallow'):
+            in_rules = True
+            if applies and value != '': #an empty Disallow allows everything
+                rules.append((field == 'allow', value))
+    return rules
+
+
+def compile_robots(rules):
+    '''Compile path patterns (with * wildcards and an optional
+    $ end anchor) into regexes matching from the start of a path.'''
+    compiled = []
+    for allowed, pattern in rules:
+        anchored = pattern.endswith('$')
+        regex = re.escape(pattern.rstrip('$')).replace('\\*', '.*')
+        compiled.append((allowed, pattern, re.compile(regex + ('$' if anchored else ''))))
+    return compiled
+
+
+def _load_robots_cache():
+    global _robots_loaded
+    _robots_loaded = True
+    if not isfile(robots_cache_path):
+        return
+    try:
+        with open(robots_cache_path) as f:
+            cached = json.load(f)
+    except Exception:
+        print("\t>> ERROR: could not read robots cache, starting afresh")
+        return
+    now = time.time()
+    for domain, (fetched, rules) in cached:
+        if now - fetched < ROBOTS_CACHE_TTL:
+            _robots[domain] = (fetched, rules, compile_robots(rules))
+
+
+def save_robots_cache(force=True):
+    '''Write the robots cache to disk if it changed, and unless force
+    is set, if it was last written over ROBOTS_SAVE_INTERVAL seconds ago.
+    The file is written outside the lock, from a snapshot.'''
+    with _robots_lock:
+        if not _robots_saved['dirty'] or (not force and time.time() - _robots_saved['time'] < ROBOTS_SAVE_INTERVAL):
+            return
+        snapshot = [(domain, entry[:2]) for domain, entry in _robots.items()]
+        _robots_saved['dirty'] = False
+        _robots_saved['time'] = time.time()
+    with open(robots_cache_path+'.tmp', 'w') as f:
+        json.dump(snapshot, f)
+    os.replace(robots_cache_path+'.tmp', robots_cache_path)
 
-    scheme = urlparse(url).scheme
-    domain = scheme + '://' + urlparse(url).netloc
-    robot_url = join(domain,"robots.txt")
-
-    disallowed = []
-    r = requests.head(robot_url)
-    if r.status_code < 400:
-        parse = False
-        content = requests.get(robot_url).text.splitlines()
-        for l in content:
-            if 'User-agent: *' in l:
-                parse = True
-            elif 'User-agent' in l and parse == True:
-                parse = False
-            elif l == 'Disallow: /' and parse == True:
-                disallowed.append(domain)
-            elif 'Disallow:' in l and parse == True:
-                m = re.search('Disallow:\s*(.+)',l)
-                if m:
-                    u = m.group(1)
-                    if u[0] == '/':
-                        u = u[1:]
-                    disallowed.append(join(domain,u))
-
-    for u in disallowed:
-        m = re.search(u.replace('*','.*'),url)
-        if m:
-            print("\t>> ERROR: robotcheck:",url,"is disallowed because of ",u)
-    if len(disallowed) > 0:
+
+atexit.register(save_robots_cache)
+
+
+def _cached_robots_rules(domain):
+    with _robots_lock:
+        if not _robots_loaded:
+            _load_robots_cache()
+        entry = _robots.get(domain)
+        if entry is not None and time.time() - entry[0] < ROBOTS_CACHE_TTL:
+            _robots.move_to_end(domain)
+            return entry[2]
+    return None
+
+
+def robots_rules(domain):
+    '''Compiled robots rules for a scheme://netloc domain, from
+    the cache if they are recent enough, otherwise fetched again.'''
+    rules = _cached_robots_rules(domain)
+    if rules is not None:
+        return rules
+    with _robots_lock:
+        fetch_lock = _robots_fetching.setdefault(domain, threading.Lock())
+    try:
+        with fetch_lock: #other threads wait for this fetch instead of repeating it
+            rules = _cached_robots_rules(domain)
+            if rules is not None:
+                return rules
+            r = fetcher.get(join(domain,"robots.txt"), timeout=10)
+            rules = parse_robots(r.text) if r.status_code < 400 else []
+            compiled = compile_robots(rules)
+            with _robots_lock:
+                _robots[domain] = (time.time(), rules, compiled)
+                _robots.move_to_end(domain)
+                while len(_robots) > ROBOTS_CACHE_SIZE:
+                    _robots.popitem(last=False)
+                _robots_saved['dirty'] = True
+    finally:
+        with _robots_lock:
+            if _robots_fetching.get(domain) is fetch_lock:
+                del _robots_fetching[domain] #threads already waiting still hold it
+    save_robots_cache(force=False)
+    return compiled
+
+
+def robotcheck(url):
+    parsed = urlparse(url)
+    domain = parsed.scheme + '://' + parsed.netloc
+    path = parsed.path or '/'
+    if parsed.query:
+        path += '?' + parsed.query
+    #the longest matching rule decides, Allow wins ties
+    best = None
+    for allowed, pattern, regex in robots_rules(domain):
+        if regex.match(path) and (best is None or (len(pattern), allowed) > (len(best[1]), best[0])):
+            best = (allowed, pattern)
+    if best is not None and not best[0]:
+        print("\t>> ERROR: robotcheck:",url,"is disallowed because of ",best[1])
         return False
-    else:
-        return True
+    return True
 
-def request_url(url):
+def request_url(url, etag=None, last_modified=None):
+    '''Check robots.txt, then GET the URL. The response is returned
+    so that parsers can use it without requesting the page again. Its
+    body is only downloaded for INDEXED_TYPES, up to MAX_BODY_SIZE.'''
     print("\n> CHECKING URL CAN BE REQUESTED")
     access = None
     req = None
     try:
-        req = requests.head(url, timeout=10)
+        if not robotcheck(url):
+            return access, req
+        req = fetcher.get(url, etag=etag, last_modified=last_modified, stream=True)
         if req.status_code >= 400:
             print("\t>> ERROR: request_url: status code is",req.status_code)
+            req.close()
+            return access, req
+        if req.status_code == 304: #not modified, no body
+            req.close()
+            return True, req
+        content_type = req.headers.get('Content-Type', '')
+        if not any(t in content_type for t in INDEXED_TYPES):
+            print("\t>> ERROR: request_url: content type", content_type, "is not indexed")
+            req.close()
+            return access, req
+        if not fetcher.read_body(req, MAX_BODY_SIZE):
+            print("\t>> ERROR: request_url: document is larger than", MAX_BODY_SIZE, "bytes")
             return access, req
-        else:
-            if robotcheck(url):
-                access = True
+        access = True
     except Exception:
-        print("\t>> ERROR: request_url: request.head failed trying to access", url, "...")
+        print("\t>> ERROR: request_url: request failed trying to access", url, "...")
+        if req is not None:
+            req.close()
         return access, req
     return access, req
 
@@ -3,10 +3,10 @@
 # SPDX-License-Identifier: AGPL-3.0-only
 
 import os
-import requests
 import codecs
 from bs4 import BeautifulSoup
 from urllib.parse import urlparse, urljoin
+from app.indexer import fetcher
 
 # check http links in same domain
 
@@ -56,7 +56,7 @@ def cache_pdf(url):
             os.makedirs(cached_dir)
         cached_page = cached_dir + page
         if not os.path.exists(cached_page):
-            response = requests.get(url)
+            response = fetcher.get(url)
             with open(cached_page, 'wb') as f:
                 f.write(response.content)
     except Exception:
@@ -65,7 +65,7 @@ def cache_pdf(url):
 
 def get_images(url):
     """Downloads all the images at 'url' to cache"""
-    req = requests.get(url, allow_redirects=True, timeout=20)
+    req = fetcher.get(url, timeout=20)
     soup = BeautifulSoup(req.text, "lxml")
     # url_parsed = list(urlparse(url))
     for image in soup.findAll("img"):
@@ -78,7 +78,7 @@ def get_images(url):
 
 def get_css(url):
     """Downloads all the css to local cache"""
-    req = requests.get(url, allow_redirects=True, timeout=20)
+    req = fetcher.get(url, timeout=20)
     soup = BeautifulSoup(req.text, "lxml")
     # url_parsed = list(urlparse(url))
     for link in soup.findAll("link"):
@@ -10,23 +10,29 @@ import numpy as np
 from scipy import sparse
 from pandas import read_csv
 from math import ceil, isnan
+from collections import Counter
+from contextlib import ExitStack
 from flask import (Blueprint,
                    flash,
                    request,
                    render_template,
+                   url_for,
                    Response)
 from app import VEC_SIZE, LANG, OWN_BRAND
 from app.api.models import Urls
 from app.indexer.neighbours import neighbour_urls
-from app.indexer import mk_page_vector, spider
+from app.indexer import mk_page_vector, spider, refresh
 from app.utils import readDocs, readUrls, readBookmarks, parse_query, init_pod, init_podsum
-from app.utils_db import pod_from_file
-from app.indexer.htmlparser import extract_links
-from app.indexer.access import request_url
-from app.indexer.posix import posix_doc
+from app.utils_db import add_to_pod_summary, get_db_urls
+from app.indexer import htmlparser
+from app.indexer.pipeline import fetch_pages
+from app.indexer.sitemap import sitemap_urls, valid_since
+from app.indexer.posix import PosixWriter
+from app.indexer import pod_summaries
 from os.path import dirname, join, realpath, isfile
 
 dir_path = dirname(dirname(realpath(__file__)))
+BATCH_SIZE = 100 #docs vectorized together during bulk indexing
 
 # Define the blueprint:
 indexer = Blueprint('indexer', __name__, url_prefix='/indexer')
@@ -148,6 +154,53 @@ def from_url():
         return render_template('indexer/progress_file.html')
 
 
+@indexer.route("/from_sitemap", methods=["POST"])
+def from_sitemap():
+    if Urls.query.count() == 0:
+        init_podsum()
+
+    if request.form['url'] != "":
+        keyword = request.form['sitemap_keyword']
+        keyword, _, lang = parse_query(keyword)
+        since = request.form.get('since', '')
+        if since and not valid_since(since):
+            flash("Please give the date as YYYY-MM-DD.", "sitemap")
+            return render_template("indexer/index.html", num_entries=Urls.query.count())
+        print(request.form['url'], keyword, lang, since)
+        #the sitemap is read by progress_sitemap, which can take long on large sites
+        f = open(join(dir_path, "sitemap_to_index.txt"), 'w')
+        f.write(request.form['url'] + ";" + keyword + ";" + lang + ";" + since + "\n")
+        f.close()
+        return render_template('indexer/progress_file.html', progress_url=url_for('indexer.progress_sitemap'))
+
+
+@indexer.route("/from_refresh", methods=["POST"])
+def from_refresh():
+    pod = request.form.get('refresh_keyword', '').strip()
+    f = open(join(dir_path, "urls_to_refresh.txt"), 'w')
+    for u in refresh.refreshable_urls(pod):
+        f.write(u + "\n")
+    f.close()
+    return render_template('indexer/progress_refresh.html')
+
+
+@indexer.route("/from_crawl", methods=["POST"])
+def from_crawl():
+    if Urls.query.count() == 0:
+        init_podsum()
+
+    if request.form['url'] != "":
+        f = open(join(dir_path, "crawl_to_index.txt"), 'w')
+        u = request.form['url']
+        keyword = request.form['crawl_keyword']
+        keyword, _, lang = parse_query(keyword)
+        max_pages = request.form.get('max_pages') or str(spider.MAX_PAGES)
+        print(u, keyword, lang, max_pages)
+        f.write(u + ";" + keyword + ";" + lang + ";" + max_pages + "\n")
+        f.close()
+        return render_template('indexer/progress_crawl.html')
+
+
 
 '''
 Controllers for progress pages.
@@ -166,23 +219,123 @@ def progress_file():
         if not urls or not keywords or not langs:
             logging.error('Invalid file format')
             yield "data: 0 \n\n"
-        kwd = keywords[0]
+        yield from index_urls(urls, keywords, langs)
+    return Response(generate(), mimetype='text/event-stream')
+
+
+@indexer.route("/progress_sitemap")
+def progress_sitemap():
+    print("Running progress sitemap")
+    def generate():
+        with open(join(dir_path, "sitemap_to_index.txt")) as f:
+            sitemap_url, kwd, lang, since = f.readline().rstrip('\n').split(';')
+        urls = []
+        for url in sitemap_urls(sitemap_url, since=since or None):
+            urls.append(url)
+            if len(urls) % 1000 == 0:
+                yield ": " + str(len(urls)) + " URLs found\n\n" #comment, keeps the stream alive
+        if not urls:
+            logging.error('No URLs found in sitemap')
+            yield "data: 0 \n\n"
+        yield from index_urls(urls, [kwd] * len(urls), [lang] * len(urls))
+    return Response(generate(), mimetype='text/event-stream')
+
+
+def index_urls(urls, keywords, langs):
+    '''Fetch and index the URLs not indexed yet, yielding the progress
+    as server-sent events.'''
+    for kwd in set(keywords):
+        init_pod(kwd)
+    #skip known URLs, then fetch the others concurrently and index them here, in order
+    known = get_db_urls(urls)
+    to_index = {}
+    for url, kwd, lang in zip(urls, keywords, langs):
+        if url not in known:
+            to_index.setdefault(url, (kwd, lang))
+    c = len(urls) - len(to_index)
+    htmlparser.reset_timings()
+    try:
+        with ExitStack() as writers:
+            #open before indexing: the pods must not be compacted while doc ids are buffered
+            posix_writers = {kwd: writers.enter_context(PosixWriter(kwd)) for kwd, _ in set(to_index.values())}
+            for url, result in fetch_pages(list(to_index)):
+                kwd, lang = to_index[url]
+                if result is not None:
+                    page, (etag, last_modified), text = result
+                    print("Computing vectors for", url, "(",kwd,")",lang)
+                    success, vector, text, doc_id = mk_page_vector.index_page(url, kwd, lang, *page, etag=etag, last_modified=last_modified, text=text)
+                    if success:
+                        posix_writers[kwd].add(text, doc_id)
+                        add_to_pod_summary(kwd, lang, vector)
+                c += 1
+                if c % BATCH_SIZE == 0:
+                    for posix_writer in posix_writers.values():
+                        posix_writer.flush()
+                data = ceil(c / len(urls) * 100)
+                yield "data:" + str(data) + "\n\n"
+    finally:
+        pod_summaries.flush()
+        print("HTML extraction timings:", htmlparser.stage_timings())
+    yield "data:" + "Finished!" + "\n\n"
+
+
+@indexer.route("/progress_crawl")
+def progress_crawl():
+    print("Running progress crawl")
+    def generate():
+        with open(join(dir_path, "crawl_to_index.txt")) as f:
+            start_url, kwd, lang, max_pages = f.readline().rstrip('\n').split(';')
         init_pod(kwd)
         c = 0
-        for url, kwd, lang in zip(urls, keywords, langs):
-            access, req = request_url(url)
-            if access:
-                url_type = req.headers['Content-Type']
-                success, podsum, text, doc_id = mk_page_vector.compute_vectors(url, kwd, lang, url_type)
-                if success:
-                    posix_doc(text, doc_id, kwd)
-                    pod_from_file(kwd, lang, podsum)
-            c += 1
-            data = ceil(c / len(urls) * 100)
-            yield "data:" + str(data) + "\n\n"
+        htmlparser.reset_timings()
+        with PosixWriter(kwd) as posix_writer:
+            for url, result in spider.crawl(start_url, max_pages=int(max_pages), skip=lambda url: bool(get_db_urls([url]))):
+                if result is not None:
+                    page, (etag, last_modified), text = result
+                    print("Computing vectors for", url, "(",kwd,")",lang)
+                    success, vector, text, doc_id = mk_page_vector.index_page(url, kwd, lang, *page, etag=etag, last_modified=last_modified, text=text)
+                    if success:
+                        posix_writer.add(text, doc_id)
+                        add_to_pod_summary(kwd, lang, vector)
+                        c += 1
+                        if c % BATCH_SIZE == 0:
+                            posix_writer.flush()
+                yield "data:" + str(c) + " pages indexed\n\n"
+        pod_summaries.flush()
+        print("HTML extraction timings:", htmlparser.stage_timings())
         yield "data:" + "Finished!" + "\n\n"
     return Response(generate(), mimetype='text/event-stream')
 
+
+@indexer.route("/progress_refresh")
+def progress_refresh():
+    print("Running progress refresh")
+    def generate():
+        with open(join(dir_path, "urls_to_refresh.txt")) as f:
+            urls = [l.rstrip('\n') for l in f if l.strip()]
+        statuses = Counter()
+        for url, status in refresh.refresh_urls(urls):
+            statuses[status] += 1
+            data = min(99, ceil(sum(statuses.values()) / len(urls) * 100))
+            yield "data:" + str(data) + "\n\n"
+        print("Refreshed", len(urls), "pages:", dict(statuses))
+        yield "data:100\n\n"
+    return Response(generate(), mimetype='text/event-stream')
+
+
+def index_batch(batch, kwd, lang, posix_writer):
+    '''Vectorize a batch of (url, doctype, title, doc) in one go,
+    then update the positional index and the pod summary.'''
+    if not batch:
+        return
+    vectors, indexed = mk_page_vector.compute_vectors_local_docs_batch(batch, kwd, lang)
+    if not indexed:
+        return
+    for text, doc_id in indexed:
+        posix_writer.add(text, doc_id)
+    add_to_pod_summary(kwd, lang, vectors)
+
+
 @indexer.route("/progress_docs")
 def progress_docs():
     logging.debug("Running progress local file")
@@ -197,8 +350,9 @@ def progress_docs():
             source, kwd, lang, doctype = line.rstrip('\n').split('::')
         init_pod(kwd)
         c = 0
+        batch = []
         #for url, title, snippet in zip(urls, titles, snippets):
-        with open(docfile) as df:
+        with open(docfile) as df, PosixWriter(kwd) as posix_writer:
             for l in df:
                 l=l.rstrip('\n')
                 if l[:4] == "<doc":
@@ -210,13 +364,16 @@ def progress_docs():
                 elif "</doc" not in l:
                     doc+=l+' '
                 else:
-                    success, podsum, text, doc_id = mk_page_vector.compute_vectors_local_docs(url, doctype, title, doc, kwd, lang)
-                    if success:
-                        posix_doc(text, doc_id, kwd)
-                        pod_from_file(kwd, lang, podsum)
+                    batch.append((url, doctype, title, doc))
                     c += 1
-                    data = ceil(c / len(urls) * 100)
-                    yield "data:" + str(data) + "\n\n"
+                    if len(batch) == BATCH_SIZE:
+                        index_batch(batch, kwd, lang, posix_writer)
+                        batch = []
+                        data = ceil(c / len(urls) * 100)
+                        yield "data:" + str(data) + "\n\n"
+            index_batch(batch, kwd, lang, posix_writer)
+        pod_summaries.flush()
+        yield "data:100\n\n"
 
     return Response(generate(), mimetype='text/event-stream')
 
@@ -239,27 +396,32 @@ def progress_csv():
             source, kwd, lang, doctype = line.rstrip('\n').split('::')
         init_pod(kwd)
         c = 0
+        batch = []
         columns = list(df.columns)
         table = df.to_numpy()
-        for i in range(table.shape[0]):
-            row = table[i]
-            print(row, type(row[0]))
-            if isinstance(row[0],float) and isnan(row[0]):
-                continue
-            title = source.replace('.csv','').title()+': '+str(row[0])+' ['+str(i)+']'
-            url = source+'#'+title
-            snippet = ''
-            for i in range(len(columns)):
-                value = str(row[i]).replace('/',' / ')
-                snippet+=str(columns[i])+': ' +value+'. '
-            print(url,title)
-            success, podsum, text, doc_id = mk_page_vector.compute_vectors_local_docs(url, doctype, title, snippet, kwd, lang)
-            if success:
-                posix_doc(text, doc_id, kwd)
-                pod_from_file(kwd, lang, podsum)
-            c += 1
-            data = ceil(c / table.shape[0] * 100)
-            yield "data:" + str(data) + "\n\n"
+        with PosixWriter(kwd) as posix_writer:
+            for i in range(table.shape[0]):
+                row = table[i]
+                print(row, type(row[0]))
+                if isinstance(row[0],float) and isnan(row[0]):
+                    continue
+                title = source.replace('.csv','').title()+': '+str(row[0])+' ['+str(i)+']'
+                url = source+'#'+title
+                snippet = ''
+                for i in range(len(columns)):
+                    value = str(row[i]).replace('/',' / ')
+                    snippet+=str(columns[i])+': ' +value+'. '
+                print(url,title)
+                batch.append((url, doctype, title, snippet))
+                c += 1
+                if len(batch) == BATCH_SIZE:
+                    index_batch(batch, kwd, lang, posix_writer)
+                    batch = []
+                    data = ceil(c / table.shape[0] * 100)
+                    yield "data:" + str(data) + "\n\n"
+            index_batch(batch, kwd, lang, posix_writer)
+        pod_summaries.flush()
+        yield "data:100\n\n"
 
     return Response(generate(), mimetype='text/event-stream')
 
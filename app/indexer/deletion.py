@@ -0,0 +1,147 @@
+# SPDX-FileCopyrightText: 2023 PeARS Project, <community@pearsproject.org>,
+#
+# SPDX-License-Identifier: AGPL-3.0-only
+
+'''Deletion of indexed documents.
+
+Deleting a document only marks its row in the deleted-row bitmap of
+its pod, which search honours at once, subtracts it from the pod
+summary and removes its Urls record. Other row ids do not move. Once
+the deleted rows of a pod exceed pod_store.MAX_DELETED_RATIO, the pod
+is compacted: its matrix, positional index and the Urls row ids
+are rewritten without them, in one pass each, all under the lock of
+the pod. Compaction is deferred to a later deletion while the pod is
+being written to, since writers hold row ids that it would change.
+
+Whole pods are removed with a few bulk DELETE statements, committed
+batch by batch so that searches are not locked out of the database.'''
+
+import uuid
+import threading
+import numpy as np
+from collections import defaultdict
+from app import db, VEC_SIZE
+from app.api.models import Urls, Pods
+from app.indexer import pod_store, pod_summaries
+from app.indexer.posix import renumber_docs_posix, remove_posix
+from app.search.pod_cache import load_pod_matrix, invalidate_pod
+from app.utils_db import get_db_urls, remove_from_pod_summary
+
+DELETE_BATCH = 10000 #Urls records deleted per transaction when removing a pod
+
+DELETING = 'deleting'
+CANCELLED = 'cancelled'
+REMOVED = 'removed'
+
+_removals = {} #removal id -> (pods to remove, Event set to cancel the removal)
+
+
+def compact(pod):
+    '''Drop the deleted rows of a pod from its matrix and positional
+    index, and renumber the Urls row ids of its documents. Returns
+    False if the pod is being written to, and left as is.'''
+    with pod_store.pod_lock(pod):
+        if pod_store.has_writers(pod):
+            print("Pod", pod, "is being written to, compaction deferred")
+            return False
+        print("Compacting pod", pod)
+        new_ids = pod_store.drop_deleted_rows(pod)
+        invalidate_pod(pod)
+        renumber_docs_posix(pod, new_ids)
+        mappings = []
+        for url_id, row_id in db.session.query(Urls.id, Urls.row_id).filter_by(pod=pod).all():
+            new_id = int(new_ids[row_id]) if row_id < len(new_ids) else -1
+            if new_id < 0:
+                print("WARNING: Urls record", url_id, "points to a deleted row of pod", pod)
+            mappings.append({'id': url_id, 'vector': str(new_id), 'row_id': new_id})
+        db.session.bulk_update_mappings(Urls, mappings)
+        db.session.commit()
+    return True
+
+
+def delete_urls(urls):
+    '''Delete indexed documents, compacting their pods if needed.
+    Returns the number of documents deleted.'''
+    by_pod = defaultdict(list)
+    for u in get_db_urls(urls).values():
+        by_pod[u.pod].append(u)
+    for pod, records in by_pod.items():
+        with pod_store.pod_lock(pod):
+            #row ids may have changed with a compaction since they were read
+            records = db.session.query(Urls).filter(Urls.id.in_([u.id for u in records])).populate_existing().all()
+            row_ids = [u.row_id for u in records]
+            removed = load_pod_matrix(pod)[row_ids]
+            num_deleted, num_rows = pod_store.delete_rows(pod, row_ids)
+            remove_from_pod_summary(pod, removed)
+            for u in records:
+                db.session.delete(u)
+            db.session.commit()
+            print("Deleted", len(records), "documents from pod", pod, "(", num_deleted, "/", num_rows, "rows deleted )")
+            if num_deleted > pod_store.MAX_DELETED_RATIO * num_rows:
+                compact(pod)
+    pod_summaries.flush()
+    return sum(len(records) for records in by_pod.values())
+
+
+def start_pod_removal(pod_names):
+    '''Id of a new, cancellable removal of the pods pod_names.'''
+    removal_id = uuid.uuid4().hex
+    _removals[removal_id] = (list(pod_names), threading.Event())
+    return removal_id
+
+
+def pods_to_remove(removal_id):
+    '''The pods of a removal, none if it is unknown or over.'''
+    return _removals[removal_id][0] if removal_id in _removals else []
+
+
+def cancel_pod_removal(removal_id):
+    '''Stop a removal after its current batch, or before it starts.'''
+    if removal_id in _removals:
+        _removals[removal_id][1].set()
+
+
+def end_pod_removal(removal_id):
+    _removals.pop(removal_id, None)
+
+
+def _cancelled(removal_id):
+    return removal_id in _removals and _removals[removal_id][1].is_set()
+
+
+def remove_pod(pod_name, keep_entry=True, removal_id=None):
+    '''Remove a pod: its Urls records, DELETE_BATCH at a time, then
+    its summary in the routing matrix and its files. Yields (status,
+    records deleted, records in the pod), status being DELETING, then
+    REMOVED, or CANCELLED if removal_id was cancelled: the pod is
+    then left in place, without the records already deleted. Unless
+    keep_entry is set, the Pods entry is deleted too.'''
+    total = db.session.query(Urls).filter_by(pod=pod_name).count()
+    num_deleted = 0
+    while True:
+        yield DELETING, num_deleted, total
+        if _cancelled(removal_id):
+            print("Removal of pod", pod_name, "cancelled")
+            yield CANCELLED, num_deleted, total
+            return
+        batch = db.session.query(Urls.id).filter_by(pod=pod_name).limit(DELETE_BATCH)
+        n = db.session.query(Urls).filter(Urls.id.in_(batch.scalar_subquery())).delete(synchronize_session=False)
+        db.session.commit()
+        if n == 0:
+            break
+        num_deleted += n
+    p = db.session.query(Pods).filter_by(name=pod_name).first()
+    if p is not None:
+        print("Reverting summary to 0")
+        pod_summaries.set_summary(int(p.DS_vector), np.zeros(VEC_SIZE), 0)
+        pod_summaries.flush()
+        if keep_entry:
+            p.registered = False
+        else:
+            db.session.delete(p)
+        db.session.commit()
+    print("Removing CSR matrix and positional index")
+    pod_store.remove_pod(pod_name)
+    invalidate_pod(pod_name)
+    remove_posix(pod_name)
+    yield REMOVED, num_deleted, total
@@ -0,0 +1,74 @@
+# SPDX-FileCopyrightText: 2023 PeARS Project, <community@pearsproject.org>,
+#
+# SPDX-License-Identifier: AGPL-3.0-only
+
+'''Shared HTTP session for the indexer.
+
+All indexer requests go through one requests.Session, so connections
+(and TLS sessions) are kept alive and reused across pages of the same
+host, with a bounded pool per host and retries on transient errors.
+Each page is fetched with a single GET, and the response is handed
+to the parsers instead of being requested again.'''
+
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+POOL_HOSTS = 100 #hosts with kept-alive connections
+POOL_SIZE = 10 #connections kept alive per host
+RETRIES = 3
+TIMEOUT = 30
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def session():
+    global _session
+    with _session_lock:
+        if _session is None:
+            retries = Retry(total=RETRIES, backoff_factor=0.5, status_forcelist=(429, 500, 502, 503, 504), raise_on_status=False)
+            adapter = HTTPAdapter(pool_connections=POOL_HOSTS, pool_maxsize=POOL_SIZE, max_retries=retries)
+            _session = requests.Session()
+            _session.mount('http://', adapter)
+            _session.mount('https://', adapter)
+        return _session
+
+
+def get(url, timeout=TIMEOUT, etag=None, last_modified=None, stream=False):
+    '''GET a URL, following redirects. If the validators of a previous
+    fetch are given, the request is conditional and an unchanged page
+    comes back as a 304 with no body. With stream, the body is left
+    unread, to be consumed from req.raw.'''
+    headers = {}
+    if etag:
+        headers['If-None-Match'] = etag
+    if last_modified:
+        headers['If-Modified-Since'] = last_modified
+    return session().get(url, headers=headers, allow_redirects=True, timeout=timeout, stream=stream)
+
+
+def read_body(req, max_bytes):
+    '''Read the body of a streamed response, up to max_bytes. It is
+    then available as req.content, as for a response that was not
+    streamed. Returns False, and closes the response, if it is longer.'''
+    length = req.headers.get('Content-Length', '')
+    if length.isdigit() and int(length) > max_bytes:
+        req.close()
+        return False
+    chunks = []
+    size = 0
+    for chunk in req.iter_content(chunk_size=65536):
+        size += len(chunk)
+        if size > max_bytes:
+            req.close()
+            return False
+        chunks.append(chunk)
+    req._content = b''.join(chunks) #returned by req.content from now on
+    return True
+
+
+def validators(req):
+    '''ETag and Last-Modified of a response, for a later conditional GET.'''
+    return req.headers.get('ETag'), req.headers.get('Last-Modified')
@@ -1,101 +1,157 @@
-# SPDX-FileCopyrightText: 2022 PeARS Project, <community@pearsproject.org>, 
+# SPDX-FileCopyrightText: 2022 PeARS Project, <community@pearsproject.org>,
 #
 # SPDX-License-Identifier: AGPL-3.0-only
 
+import time
 import logging
-import requests
-import justext
+import threading
+from functools import lru_cache
+from collections import defaultdict
+from contextlib import contextmanager
 from urllib.parse import urljoin
-from bs4 import BeautifulSoup
+from justext import get_stoplist
+from justext.core import html_to_dom, preprocessor, ParagraphMaker, classify_paragraphs, revise_paragraph_classification
 from langdetect import detect
-from app.indexer.access import request_url
-from app.indexer import detect_open
-from app.api.models import installed_languages
-from app import LANG, LANGUAGE_CODES
+from app.indexer import detect_open, fetcher
+from app.indexer.parser_settings import LANG, LANGUAGE_CODES, installed_languages
 
-def remove_boilerplates(response, lang):
-    text = ""
+LANG_SAMPLE = 2000 #characters of text given to language detection
+
+_timings = defaultdict(int)
+_timings_lock = threading.Lock()
+
+
+@contextmanager
+def timed(stage):
+    '''Add the time spent in the block to the total of a stage.'''
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        with _timings_lock:
+            _timings[stage] += time.perf_counter() - start
+
+
+def stage_timings():
+    '''Seconds spent in each stage of HTML extraction since the last
+    reset, and the number of pages extracted.'''
+    with _timings_lock:
+        return dict(_timings)
+
+
+def reset_timings():
+    with _timings_lock:
+        _timings.clear()
+
+
+def add_timings(timings):
+    '''Add timings measured elsewhere, e.g. in a worker process.'''
+    with _timings_lock:
+        for stage, t in timings.items():
+            _timings[stage] += t
+
+
+@lru_cache(maxsize=None)
+def stoplist(lang):
+    return get_stoplist(LANGUAGE_CODES[lang])
+
+
+def remove_boilerplates(dom, lang):
+    '''Text of the non-boilerplate paragraphs of a parsed page, as
+    justext.justext() would find them, without parsing the page again.'''
     print("REMOVING BOILERPLATES FOR LANG",lang,"(",LANGUAGE_CODES[lang],").")
-    paragraphs = justext.justext(
-        response.content,
-        justext.get_stoplist(LANGUAGE_CODES[lang]),
+    paragraphs = ParagraphMaker.make_paragraphs(preprocessor(dom))
+    classify_paragraphs(
+        paragraphs,
+        stoplist(lang),
         max_link_density=0.3,
         stopwords_low=0.1,
         stopwords_high=0.3,
         length_low=30,
         length_high=100)
-    for paragraph in paragraphs:
-        if not paragraph.is_boilerplate:
-            text += paragraph.text + " "
-    return text
+    revise_paragraph_classification(paragraphs)
+    return "".join(paragraph.text + " " for paragraph in paragraphs if not paragraph.is_boilerplate)
 
 
-def BS_parse(url):
-    bs_obj = None
-    req = None
+def page_language(dom, text):
+    '''Language declared in <html lang>, if installed, else detected
+    on the first LANG_SAMPLE characters of text.'''
+    declared = (dom.get('lang') or '').split('-')[0].strip().lower()
+    if declared in installed_languages:
+        return declared
+    with timed('langdetect'):
+        return detect(text[:LANG_SAMPLE])
+
+
+def parse_html(url, req=None):
+    '''Parse a page once into an lxml DOM, fetching it unless the
+    response of an earlier GET is given.'''
+    dom = None
     try:
-        req = requests.head(url, timeout=10)
-        if "text/html" not in req.headers["content-type"]:
-            print("\t>> ERROR: BS_parse: Not a HTML document...")
-            return bs_obj, req
+        if req is None:
+            req = fetcher.get(url)
     except Exception:
-        print("\t>> ERROR: BS_parse: request.head failed trying to access", url, "...")
-        pass
+        print("\t>> ERROR: parse_html: request failed trying to access", url, "...")
+        return dom, req
+    if req.status_code >= 400:
+        print("\t>> ERROR: parse_html: status code is",req.status_code)
+        return dom, req
+    if "text/html" not in req.headers.get("content-type", ""):
+        print("\t>> ERROR: parse_html: Not a HTML document...")
+        return dom, req
+    return parse_html_content(url, req.content), req
+
+
+def parse_html_content(url, content):
+    '''lxml DOM of the raw bytes of a page, or None.'''
     try:
-        req = requests.get(url, allow_redirects=True, timeout=30)
-        req.encoding = 'utf-8'
+        with timed('parse'):
+            return html_to_dom(content)
     except Exception:
-        print("\t>> ERROR: BS_parse: request failed trying to access", url, "...")
-        return bs_obj, req
-    bs_obj = BeautifulSoup(req.text, "lxml")
-    return bs_obj, req
+        print("\t>> ERROR: parse_html: could not parse", url, "...")
+        return None
 
 
-def extract_links(url):
+def extract_links(url, req=None, dom=None):
     links = []
-    try:
-        req = requests.head(url, timeout=10)
-        if req.status_code >= 400:
-            print("\t>> ERROR: extract_links: status code is",req.status_code)
-            return links
-        if "text/html" not in req.headers["content-type"]:
-            print("\t>> ERROR: Not a HTML document...")
-            return links
-    except Exception:
+    if dom is None:
+        dom, req = parse_html(url, req)
+    if dom is None:
         return links
-    bs_obj, req = BS_parse(url)
-    if not bs_obj:
-        return links
-    hrefs = bs_obj.findAll('a', href=True)
-    for h in hrefs:
-        if h['href'].startswith('http') and '#' not in h['href']:
-            links.append(h['href'])
+    for a in dom.iter('a'):
+        href = a.get('href')
+        if href is None:
+            continue
+        if href.startswith('http') and '#' not in href:
+            links.append(href)
         else:
-            links.append(urljoin(url, h['href']))
+            links.append(urljoin(url, href))
     return links
 
 
-def extract_html(url):
+def extract_html(url, req=None, dom=None):
     '''From history info, extract url, title and body of page,
-    cleaned with BeautifulSoup'''
+    cleaned with jusText. The page is parsed once (or the given dom
+    is used) for the title, the body and the declared language.'''
     title = ""
     body_str = ""
     snippet = ""
     cc = False
     language = LANG
     error = None
-    bs_obj, req = BS_parse(url)
-    if not bs_obj:
-        error = "\t>> ERROR: extract_html: Failed to get BeautifulSoup object."
+    if dom is None:
+        dom, req = parse_html(url, req)
+    if dom is None:
+        error = "\t>> ERROR: extract_html: Failed to parse page."
         return title, body_str, snippet, cc, error
-    if hasattr(bs_obj.title, 'string'):
+    title_elem = dom.find('.//title')
+    if title_elem is not None:
         if url.startswith('http'):
-            title = bs_obj.title.string
-            if title is None:
-                title = ""
-            body_str = remove_boilerplates(req, LANG)
+            title = title_elem.text_content().strip()
+            with timed('boilerplate'):
+                body_str = remove_boilerplates(dom, LANG)
             try:
-                language = detect(title + " " + body_str)
+                language = page_language(dom, title + " " + body_str)
                 print("\t>> INFO: Language for", url, ":", language)
             except Exception:
                 title = ""
@@ -107,4 +163,6 @@ def extract_html(url):
                 title = ""
                 return title, body_str, snippet, cc, error
             snippet = body_str[:300].replace(',', '-')
+    with _timings_lock:
+        _timings['pages'] += 1
     return title, body_str, snippet, cc, error
@@ -3,104 +3,148 @@
 # SPDX-License-Identifier: AGPL-3.0-only
 
 import re
+import hashlib
 import numpy as np
 import string
-from app import db, VEC_SIZE, SPM_DEFAULT_MODEL_PATH
-from app.api.models import Urls, installed_languages, sp
-from app.indexer.htmlparser import extract_html
-from app.indexer.pdfparser import extract_txt
-from app.indexer.vectorizer import vectorize_scale
+from app import db, VEC_SIZE, LANG
+from app.api.models import Urls, installed_languages
+from app.indexer import tokenizer, pod_store
+from app.indexer.vectorizer import vectorize_scale, vectorize_scale_batch
+from app.search.pod_cache import invalidate_pod
 from app.utils import convert_to_string, convert_dict_to_string, normalise
-from scipy.sparse import csr_matrix, vstack, save_npz, load_npz
+from scipy.sparse import csr_matrix
+from sqlalchemy import exc
 from os.path import dirname, join, realpath, isfile
 
 
 dir_path = dirname(dirname(realpath(__file__)))
 pod_dir = join(dir_path,'static','pods')
 
+def commit_new_urls():
+    '''Commit the Urls rows added to the session. Returns False, with
+    the session rolled back, if one of their URLs was indexed by
+    another request since it was looked up.'''
+    try:
+        db.session.commit()
+        return True
+    except exc.IntegrityError:
+        db.session.rollback()
+        return False
+
+
+def tokenize_texts(lang, texts):
+    '''Tokenize a batch of texts. Pod vectors and positional indices
+    are built on the vocabulary of the installation's default language,
+    so wordpieces must come from that language's model, whatever the
+    language of the text.'''
+    return [' '.join(pieces) for pieces in tokenizer.encode(texts, LANG)]
+
+
 def tokenize_text(lang, text):
-    sp.load(SPM_DEFAULT_MODEL_PATH)
-    tokens = [wp for wp in sp.encode_as_pieces(text.lower())]
-    text = ' '.join([wp for wp in sp.encode_as_pieces(text.lower())])
+    text = tokenize_texts(lang, [text])[0]
     #print("TOKENIZED",text)
     return text
 
 
-def compute_vec(lang, text, pod_m):
-    v = vectorize_scale(lang, text, 5, VEC_SIZE) #log prob power 5, top words 100
-    pod_m = vstack((pod_m,csr_matrix(v)))
-    return pod_m
+def compute_vec(lang, text, keyword):
+    '''Vectorize text and append it to the pod.
+    Returns the vector and its row id.'''
+    v = csr_matrix(vectorize_scale(lang, text, 5, VEC_SIZE)) #log prob power 5, top words 100
+    return v, pod_store.append_rows(keyword, v)
 
 
-def compute_vectors(target_url, keyword, lang, url_type):
-    print("Computing vectors for", target_url, "(",keyword,")",lang)
-    if not db.session.query(Urls).filter_by(url=target_url).all():
-        u = Urls(url=target_url)
-        print("CONTENT TYPE",url_type)
-        if 'text/html' in url_type:
-            title, body_str, snippet, cc, error = extract_html(target_url)
-        elif 'application/pdf' in url_type:
-            title, body_str, snippet, cc, error = extract_txt(target_url)
-        else:
-            snippet = ''
-            error = "ERROR: No supported content type."
-        if error is None and snippet != '':
-            print("TITLE",title,"SNIPPET",snippet,"CC",cc,"ERROR",error)
-            pod_m = load_npz(join(pod_dir,keyword+'.npz'))
-            text = title + " " + body_str
-            text = tokenize_text(lang, text)
-            #print(text)
-            pod_m = compute_vec(lang, text, pod_m)
-            u.title = str(title)
-            u.vector = str(pod_m.shape[0]-1)
-            u.keyword = keyword
-            u.pod = keyword
-            u.snippet = str(snippet)
-            u.doctype = 'url'
-            #print(u.url,u.title,u.vector,u.snippet,u.pod)
-            db.session.add(u)
-            db.session.commit()
-            save_npz(join(pod_dir,keyword+'.npz'),pod_m)
-            podsum = np.sum(pod_m, axis=0)
-            return True, podsum, text, u.vector
-        else:
-            if snippet == '':
-                print("IGNORING URL: Snippet empty.")
-            else:
-                print('ERROR DURING PARSING',error)
-            return False, None, None, None
-    else:
-        return False, None, None, None
+def page_hash(title, body_str):
+    '''Hash of the extracted text of a page, to detect changes on re-fetch.'''
+    return hashlib.sha256((title + "\n" + body_str).encode('utf-8')).hexdigest()
 
 
-def compute_vectors_local_docs(target_url, doctype, title, doc, keyword, lang):
-    cc = False
-    pod_m = load_npz(join(pod_dir,keyword+'.npz'))
-    if not db.session.query(Urls).filter_by(url=target_url).all():
-        print("Computing vectors for", target_url, "(",keyword,")",lang)
+def index_page(target_url, keyword, lang, title, body_str, snippet, cc, error, etag=None, last_modified=None, text=None):
+    '''Vectorize a parsed page and add it to the pod. The validators of
+    the response, if given, are kept for later conditional re-fetches.
+    text is the tokenized page, if already computed.'''
+    if error is None and snippet != '':
+        print("TITLE",title,"SNIPPET",snippet,"CC",cc,"ERROR",error)
         u = Urls(url=target_url)
-        text = title + " " + doc
-        text = tokenize_text(lang, text)
-        pod_m = compute_vec(lang, text, pod_m)
+        if text is None:
+            text = tokenize_text(lang, title + " " + body_str)
+        #print(text)
         u.title = str(title)
-        u.vector = str(pod_m.shape[0]-1)
+        v, vid = compute_vec(lang, text, keyword)
+        u.vector = str(vid)
+        u.row_id = vid
         u.keyword = keyword
         u.pod = keyword
-        if doc != "":
-            u.snippet = doc[:500]+'...'
-        else:
-            u.snippet = u.title
-        u.doctype = doctype
-        print(u.url,u.doctype,u.title,u.vector,u.snippet,u.pod)
+        u.snippet = str(snippet)
+        u.doctype = 'url'
+        u.etag = etag
+        u.last_modified = last_modified
+        u.content_hash = page_hash(str(title), body_str)
+        #print(u.url,u.title,u.vector,u.snippet,u.pod)
         db.session.add(u)
-        db.session.commit()
-        save_npz(join(pod_dir,keyword+'.npz'),pod_m)
-        podsum = np.sum(pod_m, axis=0)
-        return True, podsum, text, u.vector
+        if not commit_new_urls():
+            print("IGNORING URL: Already indexed.")
+            pod_store.delete_rows(keyword, [vid])
+            invalidate_pod(keyword)
+            return False, None, None, None
+        invalidate_pod(keyword)
+        return True, v, text, str(vid)
     else:
+        if snippet == '':
+            print("IGNORING URL: Snippet empty.")
+        else:
+            print('ERROR DURING PARSING',error)
         return False, None, None, None
 
 
+def compute_vectors_local_docs_batch(docs, keyword, lang):
+    '''Vectorize local documents in one go, for bulk ingestion.
+    docs is a list of (url, doctype, title, doc) tuples. Returns the
+    matrix of new vectors and a (text, vector id) pair for each new doc.'''
+    urls = [d[0] for d in docs]
+    known = set()
+    for i in range(0, len(urls), 500):
+        known.update(u.url for u in db.session.query(Urls.url).filter(Urls.url.in_(urls[i:i+500])).all())
+    new_docs = []
+    for d in docs:
+        if d[0] not in known:
+            known.add(d[0])
+            new_docs.append(d)
+    if not new_docs:
+        return None, []
+
+    print("Computing vectors for", len(new_docs), "docs (",keyword,")",lang)
+    texts = tokenize_texts(lang, [title + " " + doc for _, _, title, doc in new_docs])
+    vectors = vectorize_scale_batch(lang, texts, 5, VEC_SIZE)
+    first_id = pod_store.append_rows(keyword, vectors)
+    rows = list(range(len(new_docs)))
+    while rows:
+        for i in rows:
+            target_url, doctype, title, doc = new_docs[i]
+            u = Urls(url=target_url)
+            u.title = str(title)
+            u.vector = str(first_id + i)
+            u.row_id = first_id + i
+            u.keyword = keyword
+            u.pod = keyword
+            if doc != "":
+                u.snippet = doc[:500]+'...'
+            else:
+                u.snippet = u.title
+            u.doctype = doctype
+            db.session.add(u)
+        if commit_new_urls():
+            break
+        #another request indexed some of the docs meanwhile: skip those, and drop their rows
+        known = set(u.url for u in db.session.query(Urls.url).filter(Urls.url.in_([new_docs[i][0] for i in rows])).all())
+        skipped = [i for i in rows if new_docs[i][0] in known] or rows
+        print("IGNORING", len(skipped), "docs: Already indexed.")
+        pod_store.delete_rows(keyword, [first_id + i for i in skipped])
+        rows = [i for i in rows if i not in skipped]
+    invalidate_pod(keyword)
+    if not rows:
+        return None, []
+    return vectors[rows], [(texts[i], str(first_id + i)) for i in rows]
+
 
 def compute_query_vectors(query, lang):
     """ Make distribution for query """
@@ -0,0 +1,57 @@
+# SPDX-FileCopyrightText: 2023 PeARS Project, <community@pearsproject.org>,
+#
+# SPDX-License-Identifier: AGPL-3.0-only
+
+'''Process pool for the CPU-bound part of indexing.
+
+Boilerplate removal, PDF mining, language detection and tokenization
+hold the GIL, so the fetching threads cannot run them in parallel.
+Downloaded documents are sent instead, as raw bytes and a content
+type, to worker processes, which send back plain data: the parsed
+page, its tokenized text and its links. Workers never touch the
+database or the pod files, which stay owned by the request thread,
+and do not load the application at all (see parse_worker.py).
+
+Workers are started with 'spawn' rather than 'fork', since forking a
+process whose fetching threads may hold locks is unsafe. Spawned
+workers import the main script of the parent again, so scripts must
+only start the application under if __name__ == '__main__'.'''
+
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from app import PARSE_PROCESSES
+from app.indexer import htmlparser, parser_settings
+from app.indexer.parsing import process_document
+from parse_worker import init_worker
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def _get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            print("Starting", PARSE_PROCESSES, "parsing processes")
+            _pool = ProcessPoolExecutor(max_workers=PARSE_PROCESSES, mp_context=multiprocessing.get_context('spawn'), initializer=init_worker, initargs=parser_settings.current())
+        return _pool
+
+
+def process(url, content_type, content):
+    '''process_document, run in the pool of parsing processes. Blocks
+    the calling (fetching) thread until the result is back.'''
+    if PARSE_PROCESSES <= 0:
+        return process_document(url, content_type, content)[:3]
+    pool = _get_pool()
+    try:
+        page, text, links, timings = pool.submit(process_document, url, content_type, content).result()
+    except BrokenProcessPool:
+        global _pool
+        with _pool_lock:
+            if _pool is pool:
+                _pool = None #a worker died (e.g. out of memory), start afresh next time
+        raise
+    htmlparser.add_timings(timings)
+    return page, text, links
@@ -0,0 +1,25 @@
+# SPDX-FileCopyrightText: 2023 PeARS Project, <community@pearsproject.org>,
+#
+# SPDX-License-Identifier: AGPL-3.0-only
+
+'''Settings of the document parsers (htmlparser, pdfparser, tokenizer).
+They are filled in by app/__init__.py, or by parse_worker.py in parsing
+processes, which do not load the application, before any parser is imported.'''
+
+LANG = None #default language for the installation
+SPM_DEFAULT_MODEL_PATH = None #SentencePiece model of LANG
+LANGUAGE_CODES = {} #language -> name, as read by read_language_codes
+installed_languages = [] #languages with a SentencePiece model
+
+
+def configure(lang, spm_model_path, language_codes, languages):
+    global LANG, SPM_DEFAULT_MODEL_PATH, LANGUAGE_CODES, installed_languages
+    LANG = lang
+    SPM_DEFAULT_MODEL_PATH = spm_model_path
+    LANGUAGE_CODES = language_codes
+    installed_languages = languages
+
+
+def current():
+    '''The settings, in the order of the arguments of configure.'''
+    return LANG, SPM_DEFAULT_MODEL_PATH, LANGUAGE_CODES, installed_languages
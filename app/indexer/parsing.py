@@ -0,0 +1,38 @@
+# SPDX-FileCopyrightText: 2023 PeARS Project, <community@pearsproject.org>,
+#
+# SPDX-License-Identifier: AGPL-3.0-only
+
+'''Work done by the parsing processes of parse_pool. This module and
+the parsers only import parser_settings from the application, so that
+they can run in processes which do not load it (see parse_worker.py).'''
+
+from app.indexer import htmlparser, tokenizer
+from app.indexer.parser_settings import LANG
+from app.indexer.pdfparser import extract_txt
+
+
+def process_document(url, content_type, content):
+    '''Parse a downloaded document and tokenize its text. Returns the
+    page (title, body_str, snippet, cc, error), the tokenized text (None
+    if the page cannot be indexed), the links of an HTML page, and the
+    time spent per stage.'''
+    before = htmlparser.stage_timings()
+    links = []
+    if 'text/html' in content_type:
+        dom = htmlparser.parse_html_content(url, content)
+        page = htmlparser.extract_html(url, dom=dom)
+        if dom is not None:
+            links = htmlparser.extract_links(url, dom=dom)
+    elif 'application/pdf' in content_type:
+        with htmlparser.timed('pdf'):
+            page = extract_txt(url, content=content)
+    else:
+        page = "", "", "", False, "ERROR: No supported content type."
+    title, body_str, snippet, cc, error = page
+    text = None
+    if error is None and snippet != '':
+        with htmlparser.timed('tokenize'):
+            text = ' '.join(tokenizer.encode([title + " " + body_str], LANG)[0])
+    after = htmlparser.stage_timings()
+    timings = {stage: t - before.get(stage, 0) for stage, t in after.items()}
+    return page, text, links, timings
@@ -2,36 +2,43 @@
 #
 # SPDX-License-Identifier: AGPL-3.0-only
 
+import io
 import logging
-from os.path import join, dirname, realpath
-import requests
 from urllib.parse import urljoin
 from pdfminer.high_level import extract_pages
 from pdfminer.layout import LTTextContainer
 from langdetect import detect
 
-from app.indexer import detect_open
-from app.api.models import installed_languages
-from app import LANG
+from app.indexer import detect_open, fetcher
+from app.indexer.htmlparser import LANG_SAMPLE
+from app.indexer.parser_settings import LANG, installed_languages
 
-dir_path = dirname(dirname(realpath(__file__)))
-toindex_dir = join(dir_path,'static','toindex')
+PDF_MAX_PAGES = 50 #pages read from a PDF, 0 for all
+PDF_MAX_CHARS = 200000 #characters of text kept from a PDF
 
 
-def pdf_mine(pdf_path):
-    body = ""
-    for page_layout in extract_pages(pdf_path):
+def pdf_mine(pdf_file, max_pages=PDF_MAX_PAGES, max_chars=PDF_MAX_CHARS):
+    '''Text of a PDF, given as a path or a file-like object, read from
+    at most max_pages pages and cut to max_chars characters.'''
+    texts = []
+    num_chars = 0
+    for page_layout in extract_pages(pdf_file, maxpages=max_pages):
         for element in page_layout:
             if isinstance(element, LTTextContainer):
-                body+=element.get_text()
+                text = element.get_text()
+                texts.append(text)
+                num_chars += len(text)
+        if num_chars >= max_chars:
+            break
+    body = "".join(texts)[:max_chars]
     print("PDF TEXT:",body[:300])
     return body
 
 
-
-def extract_txt(url):
+def extract_txt(url, req=None, content=None):
     '''From history info, extract url, title and body of page,
-    cleaned with pdfminer'''
+    cleaned with pdfminer. The raw content of the PDF can be given
+    instead of the response.'''
     title = ""
     body_str = ""
     snippet = ""
@@ -39,23 +46,23 @@ def extract_txt(url):
     language = LANG
     error = None
     try:
-        req = requests.get(url, allow_redirects=True, timeout=30)
-        req.encoding = 'utf-8'
-        with open(join(toindex_dir,'tmp.pdf'),'wb') as f_out:
-            f_out.write(req.content)
+        if content is None:
+            if req is None:
+                req = fetcher.get(url)
+            content = req.content
     except Exception:
         print("ERROR accessing resource", url, "...")
         return title, body_str, snippet, cc, error
     
     try:
-        body_str = pdf_mine(join(toindex_dir,'tmp.pdf'))
+        body_str = pdf_mine(io.BytesIO(content)) #in memory, so safe to run in parallel
     except Exception:
         print("ERROR extracting body text from pdf...")
         return title, body_str, snippet, cc, error
 
     title = url.split('/')[-1]
     try:
-        language = detect(body_str)
+        language = detect(body_str[:LANG_SAMPLE])
         print("Language for", url, ":", language)
     except Exception:
         title = ""
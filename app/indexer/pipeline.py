@@ -0,0 +1,76 @@
+# SPDX-FileCopyrightText: 2023 PeARS Project, <community@pearsproject.org>,
+#
+# SPDX-License-Identifier: AGPL-3.0-only
+
+'''Concurrent fetch stage of the URL indexer.
+
+Pages are downloaded by a pool of threads, with at most MAX_PER_HOST
+requests in flight to any one host, and parsed by the parsing processes. Results come back
+in input order, so that a single writer (the request thread) can
+vectorize and commit them one after the other. Workers never touch
+the database.'''
+
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from urllib.parse import urlparse
+from langdetect.detector_factory import init_factory
+from app.indexer import fetcher, parse_pool
+from app.indexer.access import request_url, save_robots_cache
+
+MAX_WORKERS = 16
+MAX_PER_HOST = 2
+WINDOW = 64 #max pages fetched ahead of the writer
+
+
+def fetch_page(url):
+    '''Check a URL can be accessed, download it once and have it parsed
+    by the parsing processes. Returns the parsed page (title, body_str,
+    snippet, cc, error), the validators of the response (etag,
+    last_modified) and the tokenized text, or None.'''
+    access, req = request_url(url)
+    if not access:
+        return None
+    page, text, _ = parse_pool.process(url, req.headers.get('Content-Type', ''), req.content)
+    return page, fetcher.validators(req), text
+
+
+def fetch_pages(urls, fetch=fetch_page, max_workers=MAX_WORKERS, max_per_host=MAX_PER_HOST, window=WINDOW):
+    '''Apply fetch to urls concurrently, yielding (url, result) in
+    the order of urls. A failed fetch gives a None result.'''
+    init_factory() #load language profiles now, lazy loading is not thread-safe
+    hosts = [urlparse(url).netloc for url in urls]
+    in_flight = Counter()
+    running = {}
+    results = {}
+    waiting = []
+    next_wait = 0
+    next_yield = 0
+    pool = ThreadPoolExecutor(max_workers=max_workers)
+    try:
+        while next_yield < len(urls):
+            while next_wait < len(urls) and next_wait < next_yield + window:
+                waiting.append(next_wait)
+                next_wait += 1
+            for i in list(waiting):
+                if len(running) >= max_workers:
+                    break
+                if in_flight[hosts[i]] < max_per_host:
+                    waiting.remove(i)
+                    in_flight[hosts[i]] += 1
+                    running[pool.submit(fetch, urls[i])] = i
+            if next_yield in results:
+                yield urls[next_yield], results.pop(next_yield)
+                next_yield += 1
+                continue
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                i = running.pop(future)
+                in_flight[hosts[i]] -= 1
+                try:
+                    results[i] = future.result()
+                except Exception as e:
+                    print("\t>> ERROR: fetch_pages: failed to fetch", urls[i], e)
+                    results[i] = None
+    finally:
+        pool.shutdown(wait=False, cancel_futures=True)
+        save_robots_cache()
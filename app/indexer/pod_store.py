@@ -0,0 +1,454 @@
+# SPDX-FileCopyrightText: 2023 PeARS Project, <community@pearsproject.org>,
+#
+# SPDX-License-Identifier: AGPL-3.0-only
+
+'''Append-only storage of pod matrices.
+
+A pod is its base matrix <pod>.npz followed by a list of immutable
+segments in <pod>.segments/, recorded in manifest.json. Indexing
+appends new rows as a segment instead of rewriting the whole pod,
+and segments are merged in the background. Merges keep the row
+order, so the row ids stored in Urls.row_id never change. Pods
+without a manifest are plain .npz files and are read as before.
+
+Deleted rows are only marked in a bitmap, <pod>.deleted.npy, until
+drop_deleted_rows rewrites the pod without them. Rows imported without
+positional index are marked in another bitmap, <pod>.unindexed.npy.
+Dropping rows renumbers the others, so it must wait until no writer
+holds row ids of the pod (see writing).'''
+
+import os
+import json
+import shutil
+import threading
+import numpy as np
+from contextlib import contextmanager
+from os.path import dirname, join, realpath, isfile, isdir
+from scipy.sparse import vstack, save_npz, load_npz, csr_matrix, diags
+
+dir_path = dirname(dirname(realpath(__file__)))
+pod_dir = join(dir_path,'static','pods')
+
+MAX_SEGMENTS = 8 #start a background merge beyond this many segments
+MAX_DELETED_RATIO = 0.2 #drop deleted rows once they are this share of a pod
+
+_locks = {}
+_locks_lock = threading.Lock()
+_merging = set()
+_writers = {} #pod name -> number of open writers, see writing()
+
+
+def base_path(pod_name):
+    return join(pod_dir,pod_name+'.npz')
+
+
+def segments_dir(pod_name):
+    return join(pod_dir,pod_name+'.segments')
+
+
+def manifest_path(pod_name):
+    return join(segments_dir(pod_name),'manifest.json')
+
+
+def deleted_path(pod_name):
+    return join(pod_dir,pod_name+'.deleted.npy')
+
+
+def unindexed_path(pod_name):
+    return join(pod_dir,pod_name+'.unindexed.npy')
+
+
+def _lock(pod_name):
+    with _locks_lock:
+        return _locks.setdefault(pod_name, threading.RLock())
+
+
+def pod_lock(pod_name):
+    '''Lock serializing changes to the files of a pod (also taken by
+    the positional index and by compaction, across its steps).'''
+    return _lock(pod_name)
+
+
+@contextmanager
+def writing(pod_name):
+    '''Mark the pod as being written to, for the duration of the
+    block: row ids handed out or read meanwhile must stay valid, so
+    the pod is not compacted until every writer is done.'''
+    with _lock(pod_name):
+        _writers[pod_name] = _writers.get(pod_name, 0) + 1
+    try:
+        yield
+    finally:
+        with _lock(pod_name):
+            _writers[pod_name] -= 1
+            if _writers[pod_name] == 0:
+                del _writers[pod_name]
+
+
+def has_writers(pod_name):
+    with _lock(pod_name):
+        return pod_name in _writers
+
+
+def _stat(path):
+    if not isfile(path):
+        return None
+    st = os.stat(path)
+    return st.st_mtime_ns, st.st_size
+
+
+def _write_manifest(pod_name, manifest):
+    path = manifest_path(pod_name)
+    with open(path+'.tmp', 'w') as f:
+        json.dump(manifest, f)
+    os.replace(path+'.tmp', path)
+
+
+def _read_manifest(pod_name):
+    '''The pod's manifest, or None for a plain .npz pod. A merge into
+    the base that was interrupted is completed or rolled back here,
+    and if the base file was replaced from outside, the segments
+    recorded for the old one are dropped. The base is identified by
+    its mtime and size, which os.replace keeps from the new file.'''
+    if not isfile(manifest_path(pod_name)):
+        return None
+    with open(manifest_path(pod_name)) as f:
+        manifest = json.load(f)
+    base_stat = list(_stat(base_path(pod_name)))
+    folding = manifest.pop('folding', None)
+    if base_stat != manifest['base_stat']:
+        if folding is not None and base_stat == folding['base_stat']:
+            _fold(pod_name, manifest, folding['segments'])
+        else:
+            print("WARNING: pod", pod_name, "was replaced, dropping its segments")
+            _reset(pod_name, manifest)
+        _write_manifest(pod_name, manifest)
+    elif folding is not None:
+        _write_manifest(pod_name, manifest)
+    return manifest
+
+
+def _fold(pod_name, manifest, num_segments):
+    '''Record that the first num_segments segments are now in the base.'''
+    folded = manifest['segments'][:num_segments]
+    manifest['base_rows'] += sum(s['rows'] for s in folded)
+    manifest['base_stat'] = list(_stat(base_path(pod_name)))
+    manifest['segments'] = manifest['segments'][num_segments:]
+    for segment in folded:
+        _remove_segment(pod_name, segment)
+
+
+def _reset(pod_name, manifest):
+    '''Forget all segments, after the base was rewritten as a whole.'''
+    for segment in manifest['segments']:
+        _remove_segment(pod_name, segment)
+    manifest['segments'] = []
+    manifest['base_rows'] = load_npz(base_path(pod_name)).shape[0]
+    manifest['base_stat'] = list(_stat(base_path(pod_name)))
+
+
+def _new_manifest(pod_name):
+    os.makedirs(segments_dir(pod_name), exist_ok=True)
+    manifest = {'base_rows': load_npz(base_path(pod_name)).shape[0],
+                'base_stat': list(_stat(base_path(pod_name))),
+                'segments': [], 'next': 0}
+    _write_manifest(pod_name, manifest)
+    return manifest
+
+
+def _segment_path(pod_name, segment):
+    return join(segments_dir(pod_name), segment['file'])
+
+
+def _remove_segment(pod_name, segment):
+    if isfile(_segment_path(pod_name, segment)):
+        os.remove(_segment_path(pod_name, segment))
+
+
+def signature(pod_name):
+    '''Changes whenever the content of the pod may have changed.'''
+    return _stat(base_path(pod_name)), _stat(manifest_path(pod_name))
+
+
+def deleted_signature(pod_name):
+    return _stat(deleted_path(pod_name))
+
+
+def unindexed_signature(pod_name):
+    return _stat(unindexed_path(pod_name))
+
+
+def num_rows(pod_name):
+    with _lock(pod_name):
+        manifest = _read_manifest(pod_name)
+        if manifest is None:
+            return load_npz(base_path(pod_name)).shape[0]
+        return manifest['base_rows'] + sum(s['rows'] for s in manifest['segments'])
+
+
+def load_pod(pod_name):
+    '''The full pod matrix (CSR), from a consistent set of segments.'''
+    with _lock(pod_name):
+        manifest = _read_manifest(pod_name)
+        m = load_npz(base_path(pod_name))
+        if manifest is None or not manifest['segments']:
+            return m.tocsr()
+        segments = [load_npz(_segment_path(pod_name, s)) for s in manifest['segments']]
+    return vstack([m] + segments, format='csr')
+
+
+def append_rows(pod_name, m):
+    '''Append the rows of m to the pod as a new segment.
+    Returns the row id of the first appended row.'''
+    with _lock(pod_name):
+        manifest = _read_manifest(pod_name)
+        if manifest is None:
+            manifest = _new_manifest(pod_name)
+        first_id = manifest['base_rows'] + sum(s['rows'] for s in manifest['segments'])
+        segment = {'file': 'seg%08d.npz' % manifest['next'], 'rows': m.shape[0]}
+        manifest['next'] += 1
+        save_npz(_segment_path(pod_name, segment), m.tocsr())
+        manifest['segments'].append(segment)
+        _write_manifest(pod_name, manifest)
+        if len(manifest['segments']) > MAX_SEGMENTS and pod_name not in _merging:
+            _merging.add(pod_name)
+            threading.Thread(target=_merge_in_background, args=(pod_name,), daemon=True).start()
+    return first_id
+
+
+def rewrite_pod(pod_name, m):
+    '''Replace the whole pod with m, e.g. after removing rows.'''
+    with _lock(pod_name):
+        manifest = _read_manifest(pod_name)
+        save_npz(base_path(pod_name), m.tocsr())
+        if manifest is not None:
+            _reset(pod_name, manifest)
+            _write_manifest(pod_name, manifest)
+
+
+def _replace_rows(m, local_ids, new_rows):
+    keep = np.ones(m.shape[0])
+    keep[local_ids] = 0
+    placement = csr_matrix((np.ones(len(local_ids)), (local_ids, np.arange(len(local_ids)))), shape=(m.shape[0], len(local_ids)))
+    return (diags(keep) @ m + placement @ new_rows).astype(m.dtype).tocsr()
+
+
+def update_rows(pod_name, row_ids, m):
+    '''Overwrite the rows row_ids (distinct) of the pod with the rows
+    of m, keeping their ids. Only the files holding these rows are
+    rewritten, segments under a new name. Returns the old rows.'''
+    row_ids = np.asarray(row_ids, dtype=np.int64)
+    m = m.tocsr()
+    old_rows = [None] * len(row_ids)
+    with _lock(pod_name):
+        manifest = _read_manifest(pod_name)
+        files = [(None, load_npz(base_path(pod_name)).shape[0] if manifest is None else manifest['base_rows'])]
+        if manifest is not None:
+            files += [(s, s['rows']) for s in manifest['segments']]
+        if len(row_ids) and (row_ids.min() < 0 or row_ids.max() >= sum(rows for _, rows in files)):
+            raise IndexError("row id out of range for pod "+pod_name)
+        start = 0
+        for i, (segment, rows) in enumerate(files):
+            selected = np.flatnonzero((row_ids >= start) & (row_ids < start + rows))
+            if len(selected):
+                path = base_path(pod_name) if segment is None else _segment_path(pod_name, segment)
+                f = load_npz(path).tocsr()
+                local_ids = row_ids[selected] - start
+                for j, local_id in zip(selected, local_ids):
+                    old_rows[j] = f[local_id]
+                f = _replace_rows(f, local_ids, m[selected])
+                if segment is None:
+                    _write_base(pod_name, manifest, f)
+                else:
+                    new_segment = {'file': 'seg%08d.npz' % manifest['next'], 'rows': rows}
+                    manifest['next'] += 1
+                    save_npz(_segment_path(pod_name, new_segment), f)
+                    manifest['segments'][i-1] = new_segment
+                    _write_manifest(pod_name, manifest)
+                    _remove_segment(pod_name, segment)
+            start += rows
+    return vstack(old_rows, format='csr')
+
+
+def _write_base(pod_name, manifest, m):
+    '''Replace the base matrix, keeping the segments that follow it.'''
+    tmp_path = join(pod_dir,pod_name+'.update.tmp.npz')
+    save_npz(tmp_path, m)
+    if manifest is not None:
+        manifest['folding'] = {'segments': 0, 'base_stat': list(_stat(tmp_path))}
+        _write_manifest(pod_name, manifest)
+    os.replace(tmp_path, base_path(pod_name))
+    if manifest is not None:
+        del manifest['folding']
+        _fold(pod_name, manifest, 0)
+        _write_manifest(pod_name, manifest)
+
+
+def _load_bitmap(path):
+    if not isfile(path):
+        return np.zeros(0, dtype=bool)
+    return np.unpackbits(np.load(path)).astype(bool)
+
+
+def _save_bitmap(path, bitmap):
+    '''Atomically write a bitmap, or remove its file if it is empty.'''
+    if not bitmap.any():
+        if isfile(path):
+            os.remove(path)
+        return
+    tmp_path = path[:-len('.npy')]+'.tmp.npy'
+    np.save(tmp_path, np.packbits(bitmap))
+    os.replace(tmp_path, path)
+
+
+def _mark_rows(pod_name, path, row_ids):
+    with _lock(pod_name):
+        n = num_rows(pod_name)
+        bitmap = marked(_load_bitmap(path), np.arange(n))
+        bitmap[np.asarray(row_ids, dtype=np.int64)] = True
+        _save_bitmap(path, bitmap)
+    return int(bitmap.sum()), n
+
+
+def load_deleted(pod_name):
+    '''Bitmap of the deleted rows of the pod, as a boolean array.
+    Rows appended since the last deletion are past its end.'''
+    with _lock(pod_name):
+        return _load_bitmap(deleted_path(pod_name))
+
+
+def load_unindexed(pod_name):
+    '''Bitmap of the rows of the pod missing from its positional index.'''
+    with _lock(pod_name):
+        return _load_bitmap(unindexed_path(pod_name))
+
+
+def marked(bitmap, row_ids):
+    '''Mask of the row_ids marked in bitmap.'''
+    row_ids = np.asarray(row_ids, dtype=np.int64)
+    mask = np.zeros(len(row_ids), dtype=bool)
+    inside = row_ids < len(bitmap)
+    mask[inside] = bitmap[row_ids[inside]]
+    return mask
+
+
+def delete_rows(pod_name, row_ids):
+    '''Mark rows of the pod as deleted, leaving the matrix untouched.
+    Returns the number of deleted rows and the number of rows.'''
+    return _mark_rows(pod_name, deleted_path(pod_name), row_ids)
+
+
+def mark_unindexed(pod_name, row_ids):
+    '''Record that rows of the pod have no positional index entries.'''
+    _mark_rows(pod_name, unindexed_path(pod_name), row_ids)
+
+
+def drop_deleted_rows(pod_name):
+    '''Rewrite the pod without its deleted rows and clear the bitmap.
+    Returns the new id of each old row, -1 for the deleted ones.'''
+    with _lock(pod_name):
+        m = load_pod(pod_name)
+        deleted = marked(load_deleted(pod_name), np.arange(m.shape[0]))
+        unindexed = marked(load_unindexed(pod_name), np.arange(m.shape[0]))
+        new_ids = np.cumsum(~deleted) - 1
+        new_ids[deleted] = -1
+        rewrite_pod(pod_name, m[~deleted])
+        _save_bitmap(unindexed_path(pod_name), unindexed[~deleted])
+        _save_bitmap(deleted_path(pod_name), np.zeros(0, dtype=bool))
+    return new_ids
+
+
+def remove_pod(pod_name):
+    '''Remove the files of the pod. They are all moved out of the way
+    at once, under the lock, and only then deleted.'''
+    trash = join(pod_dir,pod_name+'.removed')
+    with _lock(pod_name):
+        if isdir(trash):
+            shutil.rmtree(trash)  # left over by an interrupted removal
+        os.makedirs(trash)
+        for path in (base_path(pod_name), deleted_path(pod_name), unindexed_path(pod_name), segments_dir(pod_name)):
+            if isfile(path) or isdir(path):
+                os.replace(path, join(trash, os.path.basename(path)))
+    shutil.rmtree(trash)
+
+
+def _merge_start(manifest):
+    '''Index of the first segment of the trailing run to merge: the
+    last two segments, plus every older one that is not bigger than
+    what is merged after it. Segment sizes then grow geometrically,
+    and each row is only rewritten a logarithmic number of times.'''
+    segments = manifest['segments']
+    start = len(segments) - 2
+    total = segments[-1]['rows'] + segments[-2]['rows']
+    while start > 0 and segments[start-1]['rows'] <= total:
+        start -= 1
+        total += segments[start]['rows']
+    return start, total
+
+
+def merge_segments(pod_name, into_base=False):
+    '''Merge a trailing run of segments into a single one, or into the
+    base matrix when they outweigh it (always, if into_base is set).
+    The merged file is written outside the lock, so readers and
+    writers are only blocked while the manifest is swapped.'''
+    with _lock(pod_name):
+        manifest = _read_manifest(pod_name)
+        if manifest is None or not manifest['segments'] or (len(manifest['segments']) < 2 and not into_base):
+            return
+        if into_base:
+            start, total = 0, sum(s['rows'] for s in manifest['segments'])
+        else:
+            start, total = _merge_start(manifest)
+        merged = manifest['segments'][start:]
+        base_stat = _stat(base_path(pod_name))
+        into_base = into_base or (start == 0 and total >= manifest['base_rows'])
+        if into_base:
+            out = {'file': 'base.tmp.npz', 'rows': total}
+        else:
+            out = {'file': 'seg%08d.npz' % manifest['next'], 'rows': total}
+            manifest['next'] += 1
+            _write_manifest(pod_name, manifest)
+
+    m = [load_npz(_segment_path(pod_name, s)) for s in merged]
+    if into_base:
+        m = [load_npz(base_path(pod_name))] + m
+    save_npz(_segment_path(pod_name, out), vstack(m, format='csr'))
+
+    with _lock(pod_name):
+        manifest = _read_manifest(pod_name)
+        if manifest is None or manifest['segments'][start:start+len(merged)] != merged \
+                or (into_base and _stat(base_path(pod_name)) != base_stat):
+            _remove_segment(pod_name, out)  # pod rewritten or removed meanwhile
+            return
+        if into_base:
+            manifest['folding'] = {'segments': len(merged), 'base_stat': list(_stat(_segment_path(pod_name, out)))}
+            _write_manifest(pod_name, manifest)
+            os.replace(_segment_path(pod_name, out), base_path(pod_name))
+            del manifest['folding']
+            _fold(pod_name, manifest, len(merged))
+        else:
+            manifest['segments'][start:start+len(merged)] = [out]
+            for segment in merged:
+                _remove_segment(pod_name, segment)
+        _write_manifest(pod_name, manifest)
+
+
+def _merge_in_background(pod_name):
+    try:
+        while True:
+            with _lock(pod_name):
+                manifest = _read_manifest(pod_name)
+                if manifest is None or len(manifest['segments']) <= MAX_SEGMENTS // 2:
+                    return
+            merge_segments(pod_name)
+    except Exception as e:
+        print("ERROR merging segments of pod", pod_name, e)
+    finally:
+        with _lock(pod_name):
+            _merging.discard(pod_name)
+
+
+def compact_pod(pod_name):
+    '''Fold all segments into the base .npz file.'''
+    merge_segments(pod_name, into_base=True)
+
@@ -0,0 +1,160 @@
+# SPDX-FileCopyrightText: 2023 PeARS Project, <community@pearsproject.org>,
+#
+# SPDX-License-Identifier: AGPL-3.0-only
+
+'''Running summaries of local pods, used to route queries to pods.
+
+Row i of the summary matrix is the sum of the document vectors of the
+pod whose Pods.DS_vector is i, and counts[i] its number of documents.
+Both are kept in memory, updated as documents are added or removed,
+and written to podsum.npy / podsum.counts.npy (dense float32) at most
+every FLUSH_INTERVAL seconds, on flush(), and at exit.'''
+
+import os
+import time
+import atexit
+import threading
+import numpy as np
+from os.path import dirname, join, realpath, isfile
+from scipy.sparse import load_npz
+from app import VEC_SIZE
+
+dir_path = dirname(dirname(realpath(__file__)))
+pod_dir = join(dir_path,'static','pods')
+sums_path = join(pod_dir,'podsum.npy')
+counts_path = join(pod_dir,'podsum.counts.npy')
+legacy_path = join(pod_dir,'podsum.npz')
+
+FLUSH_INTERVAL = 30 #seconds
+
+_lock = threading.RLock()
+_state = {'sums': None, 'counts': None, 'dirty': False, 'saved': 0.0, 'version': 0, 'routing': None}
+
+
+def _legacy_counts(num_rows):
+    '''Document counts of local pods, for summaries migrated from podsum.npz.'''
+    from app import db
+    from app.api.models import Urls, Pods
+    counts = np.zeros(num_rows, dtype=np.int64)
+    pod_idx = {p.name: int(p.DS_vector) for p in Pods.query.all() if p.DS_vector and p.DS_vector.isdigit()}
+    for pod, count in db.session.query(Urls.pod, db.func.count(Urls.id)).group_by(Urls.pod).all():
+        if pod in pod_idx and pod_idx[pod] < num_rows:
+            counts[pod_idx[pod]] = count
+    return counts
+
+
+def _load():
+    if _state['sums'] is not None:
+        return
+    if isfile(sums_path):
+        sums = np.load(sums_path)
+        counts = np.load(counts_path) if isfile(counts_path) else np.zeros(sums.shape[0], dtype=np.int64)
+    elif isfile(legacy_path):
+        print("Converting pod summaries to dense format")
+        sums = load_npz(legacy_path).toarray().astype(np.float32)
+        counts = _legacy_counts(sums.shape[0])
+    else:
+        sums = np.zeros((1,VEC_SIZE), dtype=np.float32)
+        counts = np.zeros(1, dtype=np.int64)
+    _state['sums'], _state['counts'] = sums, counts
+    _state['saved'] = time.time()
+    if not isfile(sums_path):
+        _save()
+
+
+def _save():
+    for path, arr in ((sums_path, _state['sums']), (counts_path, _state['counts'])):
+        with open(path+'.tmp', 'wb') as f:
+            np.save(f, arr)
+        os.replace(path+'.tmp', path)
+    if isfile(legacy_path):
+        os.remove(legacy_path)
+    _state['dirty'] = False
+    _state['saved'] = time.time()
+
+
+def _row(pod_idx):
+    '''Make sure row pod_idx exists, padding with empty rows.'''
+    sums = _state['sums']
+    if pod_idx >= sums.shape[0]:
+        padding = pod_idx + 1 - sums.shape[0]
+        _state['sums'] = np.vstack((sums, np.zeros((padding,VEC_SIZE), dtype=np.float32)))
+        _state['counts'] = np.concatenate((_state['counts'], np.zeros(padding, dtype=np.int64)))
+
+
+def _changed():
+    _state['dirty'] = True
+    _state['version'] += 1
+    if time.time() - _state['saved'] >= FLUSH_INTERVAL:
+        _save()
+
+
+def add_vectors(pod_idx, vectors):
+    '''Add the rows of vectors (documents newly indexed in the pod).'''
+    with _lock:
+        _load()
+        _row(pod_idx)
+        _state['sums'][pod_idx] += np.asarray(vectors.sum(axis=0), dtype=np.float32).ravel()
+        _state['counts'][pod_idx] += vectors.shape[0]
+        _changed()
+
+
+def remove_vectors(pod_idx, vectors):
+    '''Subtract the rows of vectors (documents removed from the pod).'''
+    with _lock:
+        _load()
+        _row(pod_idx)
+        _state['sums'][pod_idx] -= np.asarray(vectors.sum(axis=0), dtype=np.float32).ravel()
+        _state['counts'][pod_idx] = max(0, _state['counts'][pod_idx] - vectors.shape[0])
+        if _state['counts'][pod_idx] == 0:
+            _state['sums'][pod_idx] = 0  # no rounding leftovers in empty pods
+        _changed()
+
+
+def set_summary(pod_idx, podsum, count):
+    '''Overwrite the summary of a pod, e.g. with zeros when it is deleted.'''
+    with _lock:
+        _load()
+        _row(pod_idx)
+        _state['sums'][pod_idx] = np.asarray(podsum, dtype=np.float32).ravel()
+        _state['counts'][pod_idx] = count
+        _changed()
+
+
+def centroid(pod_idx):
+    with _lock:
+        _load()
+        if pod_idx >= _state['sums'].shape[0] or _state['counts'][pod_idx] == 0:
+            return np.zeros(VEC_SIZE, dtype=np.float32)
+        return _state['sums'][pod_idx] / _state['counts'][pod_idx]
+
+
+def routing_matrix():
+    '''Snapshot of the summary matrix and its row norms, for scoring
+    pods against a query. Only copied again after a change.'''
+    with _lock:
+        _load()
+        routing = _state['routing']
+        if routing is None or routing[0] != _state['version']:
+            sums = _state['sums'].copy()
+            routing = (_state['version'], sums, np.linalg.norm(sums, axis=1))
+            _state['routing'] = routing
+    return routing[1], routing[2]
+
+
+def reset():
+    '''Start from an empty summary matrix.'''
+    with _lock:
+        _state['sums'] = np.zeros((1,VEC_SIZE), dtype=np.float32)
+        _state['counts'] = np.zeros(1, dtype=np.int64)
+        _state['version'] += 1
+        _save()
+
+
+def flush():
+    with _lock:
+        if _state['dirty']:
+            _save()
+
+
+atexit.register(flush)
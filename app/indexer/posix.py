@@ -1,28 +1,320 @@
+'''Positional index of a pod, stored in <pod>.posx as contiguous arrays:
+
+    header         magic, version, #tokens, #postings, #positions, #docs
+    token_offsets  int64[#tokens+1], postings of token t are
+                   token_offsets[t]:token_offsets[t+1]
+    doc_deltas     int32[#postings], doc ids, delta-encoded per token
+    pos_offsets    int64[#postings+1], positions of posting j are
+                   pos_offsets[j]:pos_offsets[j+1]
+    pos_deltas     int32[#positions], positions, delta-encoded per posting
+
+The file is memory-mapped for reading and always rewritten atomically,
+under the lock of the pod (pod_store.pod_lock).
+In memory, postings are handled as a tuple of flat arrays
+(tokens, docs, lengths, positions), sorted by token then doc,
+with absolute doc ids and positions.'''
+
+import os
 import joblib
-from os.path import join, dirname, realpath
+import numpy as np
+from os.path import join, dirname, realpath, isfile
 from app import vocab
+from app.indexer import pod_store
 
-def load_posix(pod_name):
-    dir_path = dirname(dirname(realpath(__file__)))
-    posix_path = join(dir_path,'static','pods')
-    posix = joblib.load(join(posix_path,pod_name+'.pos'))
-    return posix
-
-def dump_posix(posindex, pod_name):
-    dir_path = dirname(dirname(realpath(__file__)))
-    posix_path = join(dir_path,'static','pods')
-    joblib.dump(posindex, join(posix_path,pod_name+'.pos'))
-
-
-def posix_doc(text, doc_id, pod_name):
-    posindex = load_posix(pod_name)
-    for pos, token in enumerate(text.split()):
-        if token not in vocab:
-            # tqdm.write(f"WARNING: token \"{token}\" not found in vocab")
-            continue
-        token_id = vocab[token]
-        if doc_id in posindex[token_id]:
-            posindex[token_id][doc_id] += f"|{pos}"
+dir_path = dirname(dirname(realpath(__file__)))
+posix_dir = join(dir_path,'static','pods')
+
+MAGIC = b'POSX'
+VERSION = 2
+HEADER_SIZE = 40
+OFFSET_DTYPE = np.dtype('<i8')
+DELTA_DTYPE = np.dtype('<i4')
+FLUSH_POSITIONS = 10000000 #buffered positions before a PosixWriter flushes
+
+
+def posix_path(pod_name):
+    return join(posix_dir,pod_name+'.posx')
+
+
+def legacy_posix_path(pod_name):
+    return join(posix_dir,pod_name+'.pos')
+
+
+def _starts(lengths):
+    return np.cumsum(lengths) - lengths
+
+
+def _delta_encode(values, offsets):
+    deltas = values.copy()
+    deltas[1:] -= values[:-1]
+    starts = offsets[:-1][offsets[:-1] < offsets[1:]]  # first element of each non-empty segment
+    deltas[starts] = values[starts]
+    return deltas
+
+
+def _delta_decode(deltas, offsets):
+    if len(deltas) == 0:
+        return np.zeros(0, dtype=np.int64)
+    sums = np.cumsum(deltas, dtype=np.int64)
+    starts = offsets[:-1]
+    base = np.where(starts > 0, sums[np.maximum(starts - 1, 0)], 0)
+    return sums - np.repeat(base, np.diff(offsets))
+
+
+def empty_postings():
+    empty = np.zeros(0, dtype=np.int64)
+    return empty, empty, empty, empty
+
+
+def take_postings(postings, selection):
+    '''Select (or reorder) postings, carrying their positions along.'''
+    tokens, docs, lengths, positions = postings
+    selection = np.asarray(selection, dtype=np.int64)
+    sel_lengths = lengths[selection]
+    shift = np.repeat(_starts(lengths)[selection] - _starts(sel_lengths), sel_lengths)
+    idx = np.arange(sel_lengths.sum(), dtype=np.int64) + shift
+    return tokens[selection], docs[selection], sel_lengths, positions[idx]
+
+
+def _concat_postings(all_postings):
+    return tuple(np.concatenate([p[i] for p in all_postings]) for i in range(4))
+
+
+def merge_postings(*all_postings):
+    '''Merge several sets of postings, re-sorting by token and doc.
+    The sets are expected to cover distinct docs.'''
+    tokens, docs, lengths, positions = _concat_postings(all_postings)
+    order = np.lexsort((docs, tokens))
+    return take_postings((tokens, docs, lengths, positions), order)
+
+
+def append_postings(postings, new_postings):
+    '''Merge new_postings into postings. When the new docs all come
+    after the indexed ones, as with newly appended pod rows, a stable
+    sort on tokens is enough to keep each token's docs in order.'''
+    if len(postings[1]) == 0 or len(new_postings[1]) == 0 or new_postings[1].min() <= postings[1].max():
+        return merge_postings(postings, new_postings)
+    tokens, docs, lengths, positions = _concat_postings((postings, new_postings))
+    order = np.argsort(tokens, kind='stable')
+    return take_postings((tokens, docs, lengths, positions), order)
+
+
+def doc_postings(text, doc_id):
+    '''Postings for one tokenized document.'''
+    token_ids = np.array([vocab.get(token, -1) for token in text.split()], dtype=np.int64)
+    positions = np.flatnonzero(token_ids >= 0)  # skip tokens not in vocab, keep their positions
+    token_ids = token_ids[positions]
+    order = np.argsort(token_ids, kind='stable')
+    tokens, lengths = np.unique(token_ids[order], return_counts=True)
+    docs = np.full(len(tokens), int(doc_id), dtype=np.int64)
+    return tokens, docs, lengths.astype(np.int64), positions[order].astype(np.int64)
+
+
+class PositionalIndex:
+    '''Read-only, memory-mapped view of a .posx file.'''
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            header = f.read(HEADER_SIZE)
+        if header[:4] != MAGIC:
+            raise ValueError(path+" is not a positional index file")
+        version = int(np.frombuffer(header[4:8], dtype='<u4')[0])
+        if version == 1:  # no doc count in the header
+            header = header[:32] + b'\0' * 8
+            offset = 32
         else:
-            posindex[token_id][doc_id] = f"{pos}"
-    dump_posix(posindex, pod_name)
+            offset = HEADER_SIZE
+        self.num_tokens, num_postings, num_positions, num_docs = [int(i) for i in np.frombuffer(header[8:], dtype='<u8')]
+        self.num_docs = num_docs if version > 1 else None
+        self.token_offsets, offset = self._map(path, OFFSET_DTYPE, self.num_tokens + 1, offset)
+        self.doc_deltas, offset = self._map(path, DELTA_DTYPE, num_postings, offset)
+        self.pos_offsets, offset = self._map(path, OFFSET_DTYPE, num_postings + 1, offset)
+        self.pos_deltas, offset = self._map(path, DELTA_DTYPE, num_positions, offset)
+
+    @staticmethod
+    def _map(path, dtype, count, offset):
+        nbytes = dtype.itemsize * count
+        if count == 0:
+            arr = np.zeros(0, dtype=dtype)
+        else:
+            arr = np.memmap(path, dtype=dtype, mode='r', offset=offset, shape=(count,))
+        return arr, offset + nbytes + (-nbytes % 8)
+
+    def doc_freq(self, token_id):
+        return int(self.token_offsets[token_id+1] - self.token_offsets[token_id])
+
+    def docs(self, token_id):
+        '''Sorted ids of the docs containing token_id.'''
+        start, end = self.token_offsets[token_id], self.token_offsets[token_id+1]
+        return np.cumsum(self.doc_deltas[start:end], dtype=np.int64)
+
+    def docs_with_all(self, token_ids):
+        '''Sorted ids of the docs containing all of token_ids.
+        Postings are intersected from the rarest token up, stopping
+        as soon as no doc is left. Tokens found in every doc of the
+        pod carry no signal and are not even decoded.'''
+        token_ids = sorted(set(token_ids), key=self.doc_freq)
+        if not token_ids:
+            return np.zeros(0, dtype=np.int64)
+        docs = self.docs(token_ids[0])
+        for token_id in token_ids[1:]:
+            if len(docs) == 0 or self.doc_freq(token_id) == self.num_docs:
+                break  # empty, or only tokens present everywhere left
+            postings = self.docs(token_id)
+            found = np.searchsorted(postings, docs)
+            found[found == len(postings)] = 0
+            docs = docs[postings[found] == docs] if len(postings) > 0 else postings
+        return docs
+
+    def positions(self, token_id, doc_ids):
+        '''Positions of token_id in each of doc_ids, which must all contain it.'''
+        doc_idx, positions = self.positions_flat(token_id, doc_ids)
+        return np.split(positions, np.cumsum(np.bincount(doc_idx, minlength=len(doc_ids)))[:-1])
+
+    def positions_flat(self, token_id, doc_ids):
+        '''Positions of token_id in doc_ids (which must all contain it)
+        as two flat arrays: index in doc_ids, and position.'''
+        postings = self.token_offsets[token_id] + np.searchsorted(self.docs(token_id), doc_ids)
+        starts = np.asarray(self.pos_offsets[postings], dtype=np.int64)
+        lengths = np.asarray(self.pos_offsets[postings + 1], dtype=np.int64) - starts
+        idx = np.arange(lengths.sum(), dtype=np.int64) + np.repeat(starts - _starts(lengths), lengths)
+        offsets = np.concatenate(([0], np.cumsum(lengths)))
+        positions = _delta_decode(np.asarray(self.pos_deltas[idx]), offsets)
+        return np.repeat(np.arange(len(doc_ids), dtype=np.int64), lengths), positions
+
+    def postings(self):
+        '''Decode the whole index into flat postings.'''
+        token_offsets = np.asarray(self.token_offsets)
+        pos_offsets = np.asarray(self.pos_offsets)
+        tokens = np.repeat(np.arange(self.num_tokens, dtype=np.int64), np.diff(token_offsets))
+        docs = _delta_decode(np.asarray(self.doc_deltas), token_offsets)
+        lengths = np.diff(pos_offsets)
+        positions = _delta_decode(np.asarray(self.pos_deltas), pos_offsets)
+        return tokens, docs, lengths, positions
+
+
+def write_posix(postings, pod_name, num_tokens=None):
+    '''Atomically (re)write a pod's positional index from flat postings.'''
+    if num_tokens is None:
+        num_tokens = len(vocab)
+    tokens, docs, lengths, positions = postings
+    token_offsets = np.zeros(num_tokens + 1, dtype=np.int64)
+    token_offsets[1:] = np.cumsum(np.bincount(tokens, minlength=num_tokens))
+    pos_offsets = np.zeros(len(docs) + 1, dtype=np.int64)
+    pos_offsets[1:] = np.cumsum(lengths)
+    doc_deltas = _delta_encode(docs, token_offsets)
+    pos_deltas = _delta_encode(positions, pos_offsets)
+
+    path = posix_path(pod_name)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(MAGIC)
+        f.write(np.array([VERSION], dtype='<u4').tobytes())
+        f.write(np.array([num_tokens, len(docs), len(positions), len(np.unique(docs))], dtype='<u8').tobytes())
+        for arr, dtype in ((token_offsets, OFFSET_DTYPE), (doc_deltas, DELTA_DTYPE),
+                           (pos_offsets, OFFSET_DTYPE), (pos_deltas, DELTA_DTYPE)):
+            arr = arr.astype(dtype)
+            f.write(arr.tobytes())
+            f.write(b'\0' * (-arr.nbytes % 8))
+    os.replace(tmp_path, path)
+
+
+def migrate_posix(pod_name):
+    '''Convert a legacy .pos file (list of {doc_id: "pos|pos|..."} dicts,
+    pickled with joblib) to the .posx format, and remove it.'''
+    print("Migrating positional index of", pod_name, "to .posx format")
+    posindex = joblib.load(legacy_posix_path(pod_name))
+    tokens, docs, lengths, positions = [], [], [], []
+    for token_id, postings in enumerate(posindex):
+        for doc_id in sorted(postings, key=int):
+            token_positions = [int(p) for p in postings[doc_id].split('|')]
+            tokens.append(token_id)
+            docs.append(int(doc_id))
+            lengths.append(len(token_positions))
+            positions.extend(token_positions)
+    postings = tuple(np.array(a, dtype=np.int64) for a in (tokens, docs, lengths, positions))
+    write_posix(postings, pod_name, len(posindex))
+    os.remove(legacy_posix_path(pod_name))
+
+
+def init_posix(pod_name):
+    if not isfile(posix_path(pod_name)) and not isfile(legacy_posix_path(pod_name)):
+        print("Making empty positional index for new pod")
+        write_posix(empty_postings(), pod_name)
+
+
+def load_posix(pod_name):
+    if not isfile(posix_path(pod_name)) and isfile(legacy_posix_path(pod_name)):
+        migrate_posix(pod_name)
+    return PositionalIndex(posix_path(pod_name))
+
+
+def remove_posix(pod_name):
+    for path in (posix_path(pod_name), legacy_posix_path(pod_name)):
+        if isfile(path):
+            os.remove(path)
+
+
+class PosixWriter:
+    '''Buffers the postings of newly indexed (or re-indexed) docs for a
+    pod, and merges them into its positional index in a single atomic
+    rewrite, when flushed or when more than max_positions positions are
+    buffered. It is used as a context manager, which flushes on exit:
+    until then, the pod is not compacted, so buffered doc ids stay valid.'''
+
+    def __init__(self, pod_name, max_positions=FLUSH_POSITIONS):
+        self.pod_name = pod_name
+        self.max_positions = max_positions
+        self.buffered = []
+        self.replaced = set()
+        self.num_positions = 0
+        self.writing = pod_store.writing(pod_name)
+
+    def add(self, text, doc_id):
+        postings = doc_postings(text, doc_id)
+        self.buffered.append(postings)
+        self.num_positions += len(postings[3])
+        if self.num_positions >= self.max_positions:
+            self.flush()
+
+    def replace(self, text, doc_id):
+        '''Like add, for a doc already in the index: its old postings go.'''
+        self.replaced.add(int(doc_id))
+        self.add(text, doc_id)
+
+    def flush(self):
+        if not self.buffered:
+            return
+        print("Writing positional index of", self.pod_name, "(", len(self.buffered), "new docs )")
+        with pod_store.pod_lock(self.pod_name):
+            postings = load_posix(self.pod_name).postings()
+            if self.replaced:
+                keep = np.flatnonzero(~np.isin(postings[1], list(self.replaced)))
+                postings = merge_postings(take_postings(postings, keep), *self.buffered)
+            else:
+                postings = append_postings(postings, merge_postings(*self.buffered))
+            write_posix(postings, self.pod_name)
+        self.buffered = []
+        self.replaced = set()
+        self.num_positions = 0
+
+    def __enter__(self):
+        self.writing.__enter__()
+        return self
+
+    def __exit__(self, *exc):
+        try:
+            self.flush()
+        finally:
+            self.writing.__exit__(*exc)
+
+
+def renumber_docs_posix(pod_name, new_ids):
+    '''Follow a compaction of the pod matrix: drop the docs whose
+    new id is -1 and renumber the others, in one rewrite. The new ids
+    keep the order of the old ones, so postings stay sorted.'''
+    with pod_store.pod_lock(pod_name):
+        tokens, docs, lengths, positions = load_posix(pod_name).postings()
+        keep = np.flatnonzero(new_ids[docs] >= 0)
+        tokens, docs, lengths, positions = take_postings((tokens, docs, lengths, positions), keep)
+        write_posix((tokens, new_ids[docs], lengths, positions), pod_name)
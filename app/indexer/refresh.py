@@ -0,0 +1,131 @@
+# SPDX-FileCopyrightText: 2023 PeARS Project, <community@pearsproject.org>,
+#
+# SPDX-License-Identifier: AGPL-3.0-only
+
+'''Re-indexing of web pages already in the database.
+
+Pages are re-fetched with conditional requests, using the ETag and
+Last-Modified of the last fetch, so that unchanged pages come back as
+an empty 304. Pages that are downloaded again are only re-vectorized
+if the hash of their extracted text changed. Their pod rows, positional
+index entries and pod summary are then updated in place, keeping
+their row ids.'''
+
+from contextlib import ExitStack
+from scipy.sparse import csr_matrix, vstack
+from app import db, VEC_SIZE, LANG
+from app.api.models import Urls, Pods
+from app.indexer import fetcher, pod_store, pod_summaries, parse_pool
+from app.indexer.access import request_url
+from app.indexer.mk_page_vector import page_hash
+from app.indexer.pipeline import fetch_pages
+from app.indexer.posix import PosixWriter
+from app.indexer.vectorizer import vectorize_scale
+from app.search.pod_cache import invalidate_pod
+from app.utils_db import add_to_pod_summary, remove_from_pod_summary
+
+BATCH_SIZE = 100 #changed pages written to a pod at once
+
+NOT_MODIFIED = 'not modified'
+UNCHANGED = 'unchanged'
+CHANGED = 'changed'
+FAILED = 'failed'
+
+
+def fetch_if_modified(url, etag, last_modified):
+    '''Conditional version of pipeline.fetch_page, returning
+    NOT_MODIFIED if the server says the page did not change.'''
+    access, req = request_url(url, etag=etag, last_modified=last_modified)
+    if not access:
+        return None
+    if req.status_code == 304:
+        return NOT_MODIFIED
+    page, text, _ = parse_pool.process(url, req.headers.get('Content-Type', ''), req.content)
+    return page, fetcher.validators(req), text
+
+
+def refreshable_urls(pod=None):
+    '''Web pages in the database, from all pods or from one.'''
+    query = db.session.query(Urls.url).filter_by(doctype='url')
+    if pod:
+        query = query.filter_by(pod=pod)
+    return [u.url for u in query.all()]
+
+
+def _write_changes(pod, lang, changes):
+    '''Write the re-indexed pages of a pod, then commit them to the
+    database: if interrupted before, they are just refreshed again.'''
+    row_ids = sorted(changes)
+    vectors = vstack([changes[i][1] for i in row_ids], format='csr')
+    old_vectors = pod_store.update_rows(pod, row_ids, vectors)
+    invalidate_pod(pod)
+    with PosixWriter(pod) as posix_writer:
+        for i in row_ids:
+            posix_writer.replace(changes[i][2], i)
+    remove_from_pod_summary(pod, old_vectors)
+    add_to_pod_summary(pod, lang, vectors)
+    for i in row_ids:
+        u, _, _, fields = changes[i]
+        for k, v in fields.items():
+            setattr(u, k, v)
+    db.session.commit()
+
+
+def refresh_urls(urls):
+    '''Refresh indexed web pages, yielding (url, status) for each,
+    status being NOT_MODIFIED, UNCHANGED, CHANGED or FAILED. Their pods
+    are not compacted meanwhile, so that their row ids stay valid.'''
+    pods = set()
+    for i in range(0, len(urls), 500):
+        pods.update(pod for pod, in db.session.query(Urls.pod).filter(Urls.url.in_(urls[i:i+500])).distinct())
+    with ExitStack() as writers:
+        for pod in pods:
+            writers.enter_context(pod_store.writing(pod))
+        yield from _refresh_urls(urls)
+
+
+def _refresh_urls(urls):
+    records = {}
+    for i in range(0, len(urls), 500):
+        for u in db.session.query(Urls).filter(Urls.url.in_(urls[i:i+500])).all():
+            if u.doctype == 'url':
+                records[u.url] = u
+    validators = {url: (u.etag, u.last_modified) for url, u in records.items()}
+    langs = {}
+    pending = {} #pod -> {row id: (Urls record, vector, text, new field values)}
+    try:
+        for url, result in fetch_pages(list(records), fetch=lambda url: fetch_if_modified(url, *validators[url])):
+            u = records[url]
+            if result is None:
+                yield url, FAILED
+                continue
+            if result == NOT_MODIFIED:
+                yield url, NOT_MODIFIED
+                continue
+            (title, body_str, snippet, cc, error), (etag, last_modified), text = result
+            if text is None:
+                yield url, FAILED
+                continue
+            content_hash = page_hash(str(title), body_str)
+            if content_hash == u.content_hash:
+                u.etag, u.last_modified = etag, last_modified
+                yield url, UNCHANGED
+                continue
+            if u.pod not in langs:
+                p = db.session.query(Pods).filter_by(name=u.pod).first()
+                langs[u.pod] = p.language if p is not None and p.language else LANG
+            lang = langs[u.pod]
+            print("Re-computing vector for", url, "(",u.pod,")",lang)
+            v = csr_matrix(vectorize_scale(lang, text, 5, VEC_SIZE))
+            fields = {'title': str(title), 'snippet': str(snippet), 'content_hash': content_hash,
+                      'etag': etag, 'last_modified': last_modified}
+            changes = pending.setdefault(u.pod, {})
+            changes[u.row_id] = (u, v, text, fields)
+            if len(changes) >= BATCH_SIZE:
+                _write_changes(u.pod, lang, pending.pop(u.pod))
+            yield url, CHANGED
+    finally:
+        for pod, changes in pending.items():
+            _write_changes(pod, langs[pod], changes)
+        db.session.commit()
+        pod_summaries.flush()
@@ -0,0 +1,139 @@
+# SPDX-FileCopyrightText: 2023 PeARS Project, <community@pearsproject.org>,
+#
+# SPDX-License-Identifier: AGPL-3.0-only
+
+'''URL discovery from sitemaps.
+
+A sitemap (or sitemap index, possibly gzipped) is streamed from the
+server and parsed incrementally, so that even a 50MB sitemap with 50k
+URLs is read without holding the whole document in memory.'''
+
+import re
+import gzip
+from datetime import datetime
+from collections import deque
+from xml.etree.ElementTree import iterparse
+from app.indexer import fetcher
+from app.indexer.access import robotcheck
+
+MAX_SITEMAPS = 100 #sitemaps read when following a sitemap index
+MAX_URLS = 100000 #URLs returned for one sitemap
+MAX_SITEMAP_SIZE = 50 * 1024 * 1024 #bytes once decompressed, as in the sitemap protocol
+
+
+class _Reader:
+    '''File-like wrapper putting head back in front of f, and failing
+    once more than limit bytes are read.'''
+
+    def __init__(self, f, head=b'', limit=None):
+        self.f = f
+        self.head = head
+        self.left = limit
+
+    def read(self, size=-1):
+        if self.head:
+            data, self.head = self.head, b''
+            if size is None or size < 0:
+                data += self.f.read()
+        else:
+            data = self.f.read(size)
+        if self.left is None:
+            return data
+        self.left -= len(data)
+        if self.left < 0:
+            raise ValueError("sitemap larger than %d bytes" % MAX_SITEMAP_SIZE)
+        return data
+
+
+_W3C_DATETIME = re.compile(r'(\d{4}(?:-\d{2}(?:-\d{2})?)?)(?:T.*)?$') #YYYY, YYYY-MM, YYYY-MM-DD or a full datetime
+
+
+def valid_since(since):
+    '''Whether since is a date in YYYY-MM-DD format.'''
+    if not re.fullmatch(r'\d{4}-\d{2}-\d{2}', since):
+        return False
+    try:
+        datetime.strptime(since, '%Y-%m-%d')
+        return True
+    except ValueError:
+        return False
+
+
+def modified_before(lastmod, since):
+    '''Whether the lastmod of a sitemap entry (a W3C datetime, possibly
+    only a year or a month) is before the date since, at the precision
+    of lastmod. An unreadable lastmod is not before anything.'''
+    m = _W3C_DATETIME.match(lastmod)
+    if m is None:
+        return False
+    date = m.group(1)
+    return date < since[:len(date)]
+
+
+def _tag(elem):
+    return elem.tag.rsplit('}', 1)[-1]
+
+
+def read_sitemap(url):
+    '''Yield (kind, loc, lastmod) for the entries of one sitemap, kind
+    being 'url' for a page and 'sitemap' for a child sitemap of an index.'''
+    if not robotcheck(url):
+        return
+    req = fetcher.get(url, stream=True)
+    try:
+        if req.status_code >= 400:
+            print("\t>> ERROR: read_sitemap: status code is", req.status_code)
+            return
+        req.raw.decode_content = True #undo Content-Encoding
+        head = req.raw.read(2)
+        stream = _Reader(req.raw, head)
+        if head == b'\x1f\x8b': #sitemap.xml.gz
+            stream = gzip.GzipFile(fileobj=stream)
+        loc, lastmod = None, None
+        root = None
+        for event, elem in iterparse(_Reader(stream, limit=MAX_SITEMAP_SIZE), events=('start', 'end')):
+            if root is None:
+                root = elem
+            if event == 'start':
+                continue
+            tag = _tag(elem)
+            if tag == 'loc':
+                loc = (elem.text or '').strip()
+            elif tag == 'lastmod':
+                lastmod = (elem.text or '').strip()
+            elif tag in ('url', 'sitemap'):
+                if loc:
+                    yield tag, loc, lastmod
+                loc, lastmod = None, None
+                root.clear() #drop parsed entries
+    finally:
+        req.close()
+
+
+def sitemap_urls(sitemap_url, since=None, max_urls=MAX_URLS):
+    '''Yield the page URLs listed in a sitemap, following sitemap index
+    files. With since (YYYY-MM-DD), entries with an older lastmod are
+    skipped; entries without lastmod are kept.'''
+    queue = deque([sitemap_url])
+    seen = {sitemap_url}
+    num_sitemaps = 0
+    num_urls = 0
+    while queue and num_sitemaps < MAX_SITEMAPS:
+        url = queue.popleft()
+        num_sitemaps += 1
+        print("Reading sitemap", url)
+        try:
+            for kind, loc, lastmod in read_sitemap(url):
+                if since and lastmod and modified_before(lastmod, since):
+                    continue
+                if kind == 'sitemap':
+                    if loc not in seen:
+                        seen.add(loc)
+                        queue.append(loc)
+                elif loc.startswith(('http://', 'https://')):
+                    yield loc
+                    num_urls += 1
+                    if num_urls >= max_urls:
+                        return
+        except Exception as e:
+            print("\t>> ERROR: sitemap_urls: could not read", url, e)
@@ -1,58 +1,203 @@
-# SPDX-FileCopyrightText: 2022 PeARS Project, <community@pearsproject.org>, 
+# SPDX-FileCopyrightText: 2022 PeARS Project, <community@pearsproject.org>,
 #
 # SPDX-License-Identifier: AGPL-3.0-only
 
-'''Spider code, heavily influenced by http://www.netinstructions.com/how-to-make-a-web-crawler-in-under-50-lines-of-python-code/.'''
-
-from html.parser import HTMLParser  
-from urllib.request import urlopen  
-from urllib import parse
-
-'''LinkParser inherits from HTMLParser'''
-class LinkParser(HTMLParser):
-
-    def handle_starttag(self, tag, attrs):
-        '''Extending HTMLParser's function'''
-        if tag == 'a':
-            for (key, value) in attrs:
-                if key == 'href':
-                    new_url = parse.urljoin(self.base, value)
-                    self.links = self.links + [new_url]
-
-    def getLinks(self, url):
-        '''New function not in HTMLParser'''
-        self.links = []
-        self.base = url
-        response = urlopen(url)
-        if 'text/html' in response.getheader('Content-Type'):
-            htmlBytes = response.read()
-            # Note that feed() handles Strings well, but not bytes
-            # (A change from Python 2.x to Python 3.x)
-            htmlString = htmlBytes.decode("utf-8")
-            self.feed(htmlString)
-            return htmlString, self.links
+'''Spider code: crawls a website, starting from a URL and following
+the links that stay under it. The frontier (URLs left to visit) is a
+FIFO queue with a set of hashes of all URLs ever queued, saved to disk
+so that an interrupted or budget-limited crawl resumes where it stopped.'''
+
+import os
+import json
+import time
+import hashlib
+import threading
+from collections import deque, defaultdict
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from os.path import dirname, join, realpath, isfile
+from urllib.parse import urlsplit, urlunsplit, urldefrag
+from langdetect.detector_factory import init_factory
+from app.indexer import fetcher, parse_pool
+from app.indexer.access import request_url, save_robots_cache
+from app.indexer.htmlparser import extract_links
+
+dir_path = dirname(dirname(realpath(__file__)))
+crawl_dir = join(dir_path,'static','crawls')
+
+MAX_PAGES = 10000 #pages fetched per crawl
+MAX_DEPTH = 10 #links followed from the start page
+MAX_WORKERS = 8
+CRAWL_DELAY = 1.0 #min seconds between two requests to the same host
+SAVE_EVERY = 50 #pages between two saves of the frontier
+
+DEFAULT_PORTS = {'http': ':80', 'https': ':443'}
+
+
+def normalise_url(url):
+    '''Canonical form of an http(s) URL, or None for other schemes:
+    no fragment, lowercase scheme and host, no default port, / for
+    an empty path.'''
+    url = urldefrag(url.strip())[0]
+    scheme, netloc, path, query, _ = urlsplit(url)
+    scheme = scheme.lower()
+    if scheme not in DEFAULT_PORTS:
+        return None
+    netloc = netloc.lower()
+    if netloc.endswith(DEFAULT_PORTS[scheme]):
+        netloc = netloc[:-len(DEFAULT_PORTS[scheme])]
+    return urlunsplit((scheme, netloc, path or '/', query, ''))
+
+
+def url_hash(url):
+    return int.from_bytes(hashlib.blake2b(url.encode('utf-8'), digest_size=8).digest(), 'big')
+
+
+class Frontier:
+    '''Queue of (url, depth) pairs to visit, never holding a URL twice.'''
+
+    def __init__(self, path=None):
+        self.path = path
+        self.queue = deque()
+        self.seen = set()
+
+    def __len__(self):
+        return len(self.queue)
+
+    def add(self, url, depth):
+        key = url_hash(url)
+        if key in self.seen:
+            return False
+        self.seen.add(key)
+        self.queue.append((url, depth))
+        return True
+
+    def pop(self):
+        return self.queue.popleft()
+
+    def save(self, pending=()):
+        '''Write the frontier to disk, with the pending (url, depth)
+        pairs that were popped but not processed yet put back first.'''
+        with open(self.path+'.tmp', 'w') as f:
+            json.dump({'queue': list(pending) + list(self.queue), 'seen': list(self.seen)}, f)
+        os.replace(self.path+'.tmp', self.path)
+
+    def remove(self):
+        if isfile(self.path):
+            os.remove(self.path)
+
+    @classmethod
+    def for_crawl(cls, start_url):
+        '''The saved frontier of an unfinished crawl from start_url,
+        or a new one holding only start_url.'''
+        os.makedirs(crawl_dir, exist_ok=True)
+        frontier = cls(join(crawl_dir, '%016x.json' % url_hash(start_url)))
+        if isfile(frontier.path):
+            with open(frontier.path) as f:
+                saved = json.load(f)
+            frontier.queue = deque(tuple(p) for p in saved['queue'])
+            frontier.seen = set(saved['seen'])
+            print("Resuming crawl of", start_url, ":", len(frontier), "URLs left in frontier")
         else:
-            return "",[]
+            frontier.add(start_url, 0)
+        return frontier
+
+
+class HostDelays:
+    '''Spaces out requests to the same host by at least delay seconds.'''
+
+    def __init__(self, delay):
+        self.delay = delay
+        self.next_slot = defaultdict(float)
+        self.lock = threading.Lock()
+
+    def wait(self, url):
+        host = urlsplit(url).netloc
+        with self.lock:
+            now = time.time()
+            slot = max(now, self.next_slot[host])
+            self.next_slot[host] = slot + self.delay
+        time.sleep(slot - now)
+
+
+def fetch_page_and_links(url, delays):
+    '''Fetch a page once, returning its parsed content (as for
+    pipeline.fetch_page) and the links it contains.'''
+    delays.wait(url)
+    access, req = request_url(url)
+    if not access:
+        return None, []
+    page, text, links = parse_pool.process(url, req.headers.get('Content-Type', ''), req.content)
+    return (page, fetcher.validators(req), text), links
+
+
+def crawl(start_url, max_pages=MAX_PAGES, max_depth=MAX_DEPTH, max_workers=MAX_WORKERS, delay=CRAWL_DELAY, skip=None):
+    '''Crawl the pages under the directory of start_url, fetching
+    concurrently, and yield (url, result) for each fetched page, result
+    being as for pipeline.fetch_page. Stops after max_pages pages; the
+    frontier is then kept on disk, and the next crawl of start_url resumes it.
+    Pages for which skip(url) is true (e.g. already indexed) are not
+    fetched, so their links are not followed either; the start page is
+    still fetched for its links, but yielded with a None result.'''
+    start_url = normalise_url(start_url)
+    scope = start_url[:start_url.rfind('/')+1]
+    frontier = Frontier.for_crawl(start_url)
+    skip_start = skip is not None and skip(start_url)
+    delays = HostDelays(delay)
+    init_factory() #load language profiles now, lazy loading is not thread-safe
+    pool = ThreadPoolExecutor(max_workers=max_workers)
+    running = {}
+    fetched = 0
+    try:
+        while frontier or running:
+            while frontier and len(running) < max_workers and fetched + len(running) < max_pages:
+                url, depth = frontier.pop()
+                if url != start_url and skip is not None and skip(url):
+                    continue
+                running[pool.submit(fetch_page_and_links, url, delays)] = (url, depth)
+            if not running:
+                break
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                url, depth = running.pop(future)
+                try:
+                    result, links = future.result()
+                except Exception as e:
+                    print("\t>> ERROR: crawl: failed to fetch", url, e)
+                    result, links = None, []
+                fetched += 1
+                if depth < max_depth:
+                    for link in links:
+                        link = normalise_url(link)
+                        if link is not None and link.startswith(scope):
+                            frontier.add(link, depth + 1)
+                if fetched % SAVE_EVERY == 0:
+                    frontier.save(pending=list(running.values()))
+                yield url, None if url == start_url and skip_start else result
+    finally:
+        pool.shutdown(wait=False, cancel_futures=True)
+        if frontier or running:
+            frontier.save(pending=list(running.values()))
+        else:
+            frontier.remove()
+        save_robots_cache()
+
 
-def get_links(base_url, max_pages):  
-    pages_to_visit = [base_url]
+def get_links(base_url, max_pages):
+    '''URLs of up to max_pages pages under base_url, fetched one by one.'''
+    base_url = normalise_url(base_url)
+    scope = base_url[:base_url.rfind('/')+1]
+    frontier = Frontier()
+    frontier.add(base_url, 0)
     pages_visited = []
-    number_visited = 0
-    while number_visited < max_pages and pages_to_visit != []:
-        number_visited+=1
-        # Start from base url
-        url = pages_to_visit[0]
-        if not url.startswith(base_url):
-            continue
+    while len(pages_visited) < max_pages and frontier:
+        url, _ = frontier.pop()
         pages_visited.append(url)
-        pages_to_visit = pages_to_visit[1:]
         try:
-            print(number_visited, "Scraping:", url)
-            parser = LinkParser()
-            data, links = parser.getLinks(url)
-            for link in links:
-                if link not in pages_visited and link not in pages_to_visit and '#' not in link and base_url in link:
-                    pages_to_visit.append(link)
-        except:
+            print(len(pages_visited), "Scraping:", url)
+            for link in extract_links(url):
+                link = normalise_url(link)
+                if link is not None and link.startswith(scope):
+                    frontier.add(link, 0)
+        except Exception:
             print(" **Failed visiting current url!**")
     return pages_visited
@@ -0,0 +1,45 @@
+# SPDX-FileCopyrightText: 2023 PeARS Project, <community@pearsproject.org>, 
+#
+# SPDX-License-Identifier: AGPL-3.0-only
+
+'''SentencePiece processors, one per installed language.
+Each model is loaded lazily, the first time it is needed,
+and then shared by all threads (encoding is read-only).'''
+
+import threading
+import sentencepiece as spm
+from os.path import dirname, join
+from app.indexer.parser_settings import LANG, SPM_DEFAULT_MODEL_PATH, installed_languages
+
+models_dir = dirname(dirname(SPM_DEFAULT_MODEL_PATH))
+
+_processors = {}
+_lock = threading.Lock()
+
+
+def model_path(lang):
+    if lang == LANG:
+        return SPM_DEFAULT_MODEL_PATH
+    return join(models_dir, lang, lang+'wiki.lite.16k.model')
+
+
+def get_processor(lang):
+    if lang not in installed_languages:
+        print("No SentencePiece model for", lang, "- using", LANG)
+        lang = LANG
+    sp = _processors.get(lang)
+    if sp is None:
+        with _lock:
+            sp = _processors.get(lang)
+            if sp is None:
+                print("Loading SentencePiece model", model_path(lang))
+                sp = spm.SentencePieceProcessor()
+                sp.load(model_path(lang))
+                _processors[lang] = sp
+    return sp
+
+
+def encode(texts, lang):
+    '''Lowercase and split a batch of texts into wordpieces,
+    returning one list of pieces per text.'''
+    return get_processor(lang).encode([text.lower() for text in texts], out_type=str)
@@ -7,6 +7,8 @@ import numpy as np
 from scipy.sparse import csr_matrix, vstack
 from sklearn import preprocessing
 
+_logprob_weights = {}
+
 def read_vocab(vocab_file):
     c = 0
     vocab = {}
@@ -42,12 +44,33 @@ def wta_vectorized(feature_mat, k, percent=True):
     feature_mat[is_smaller_than_kth] = 0
     return feature_mat
 
+def wta_sparse(X, k):
+    '''Sparse equivalent of wta_vectorized(X, k, False) for non-negative
+    CSR matrices: in each row, zero the values smaller than the k-th largest.'''
+    X = csr_matrix(X, copy=True)
+    nnz = np.diff(X.indptr)
+    rows = np.repeat(np.arange(X.shape[0]), nnz)
+    order = np.lexsort((-X.data, rows))  # by row, then by decreasing value
+    rank = np.empty_like(order)
+    rank[order] = np.arange(len(order)) - X.indptr[rows[order]]
+    kth_vals = np.zeros(X.shape[0])
+    is_kth = rank == k - 1
+    kth_vals[rows[is_kth]] = X.data[is_kth]  # rows with fewer than k values keep everything
+    X.data[X.data < kth_vals[rows]] = 0
+    X.eliminate_zeros()
+    return X
+
+def logprob_weights(logprobs, power):
+    '''Log probabilities raised to power, computed once per power.'''
+    key = (id(logprobs), power)
+    if key not in _logprob_weights:
+        _logprob_weights[key] = np.array(logprobs) ** power
+    return _logprob_weights[key]
+
 def encode_docs(doc_list, vectorizer, logprobs, power, top_words):
-    logprobs = np.array([logprob ** power for logprob in logprobs])
-    X = vectorizer.fit_transform(doc_list)
-    X = X.multiply(logprobs)
-    X = wta_vectorized(X.toarray(),top_words,False)
-    X = csr_matrix(X)
+    X = vectorizer.transform(doc_list)
+    X = csr_matrix(X.multiply(logprob_weights(logprobs, power)))
+    X = wta_sparse(X, top_words)
     return X
 
 def read_n_encode_dataset(doc=None, vectorizer=None, logprobs=None, power=None, top_words=None, verbose=False):
@@ -76,5 +99,10 @@ def scale(dataset):
     return scaler.transform(dataset)
 
 def vectorize_scale(lang, text, logprob_power, top_words):
-    dataset = vectorize(lang, text, logprob_power,top_words)
-    return scale(dataset)
+    return vectorize_scale_batch(lang, [text], logprob_power, top_words).toarray()
+
+def vectorize_scale_batch(lang, texts, logprob_power, top_words):
+    '''Vectorize a list of tokenized texts into one L2-normalised
+    CSR matrix, with one row per text.'''
+    X = encode_docs(texts, vectorizer, logprobs, logprob_power, top_words)
+    return preprocessing.normalize(X, norm='l2')
@@ -1,3 +1,4 @@
+from glob import glob
 from os.path import dirname, join, realpath, isfile
 
 def read_language_codes():
@@ -18,3 +19,11 @@ def read_stopwords(lang):
         STOPWORDS = f.read().splitlines()
     return STOPWORDS
 
+def get_installed_languages():
+    installed_languages = []
+    language_paths = glob('./app/api/models/*/')
+    for p in language_paths:
+        lang = p[:-1].split('/')[-1]
+        installed_languages.append(lang)
+    print("Installed languages:",installed_languages)
+    return installed_languages
@@ -10,14 +10,15 @@ from os.path import dirname, join, realpath
 from app import db, VEC_SIZE
 from app.api.models import Pods, Urls
 from app.utils import readPods, get_pod_info, convert_to_string, parse_query
-from app.utils_db import pod_from_json, url_from_json, pod_from_file
+from app.utils_db import pod_from_json, url_from_json, local_pod
+from app.pod_finder.import_pod import import_pod
 from app.pod_finder import score_pods, index_pod_file
 from app.pod_finder.download_pod_list import download_pod_centroids
+from app.indexer.deletion import remove_pod, start_pod_removal, pods_to_remove, cancel_pod_removal, end_pod_removal, CANCELLED
 import joblib
 import re
 from scipy.sparse import load_npz, save_npz, csr_matrix
 import numpy as np
-from os import remove
 
 dir_path = dirname(dirname(dirname(realpath(__file__))))
 pod_dir = join(dir_path, 'app', 'static', 'pods')
@@ -112,43 +113,12 @@ def subscribe_from_file():
 
 @pod_finder.route("/progress_file")
 def progress_file():
+    hfile = join(dir_path, "app", "static", "pods", "urls_from_pod.fh")
+    pod_name, lang, m, titles, urls = joblib.load(hfile)
+    pod_entry = local_pod(pod_name, lang)
     def generate():
-        c = 0
-        new_urls = list()
-        pod_name = ""
-        hfile = join(dir_path, "app", "static", "pods", "urls_from_pod.fh")
-        pod_name, lang, m, titles, urls = joblib.load(hfile)
-        pod_entry = db.session.query(Pods).filter_by(name=pod_name).first()
-        for i in range(len(titles)):
-            title = titles[i]
-            url = urls[i]
-            vector = convert_to_string(m[i])
-            if not db.session.query(Urls).filter_by(url=url).all():
-                u = Urls(
-                    url=url,
-                    title=title,
-                    snippet=title, #FIX
-                    pod=pod_name,
-                    vector=vector,
-                    cc=True if 'wikipedia.org' in url else False)
-                new_urls.append(u)
-        db.session.commit()
-        
-        if len(new_urls) == 0:
-            print("All URLs already known.")
-            yield "data:" + "100" + "\n\n"
-        else:
-            c = 0
-            for u in new_urls:
-                #print("Adding",u.url,"to DB")
-                try:
-                    db.session.add(u)
-                    db.session.commit()
-                    c += 1
-                except:
-                    print("Failed to add",u.url,"to DB...")
-                yield "data:" + str(int(c / len(urls) * 100)) + "\n\n"
-                pod_from_file(pod_name, lang)        
+        for inserted, total in import_pod(pod_entry, m, titles, urls):
+            yield "data:" + str(int(inserted / total * 100) if total else 100) + "\n\n"
     return Response(generate(), mimetype='text/event-stream')
 
 
@@ -160,55 +130,33 @@ def progress_pods():
     print("Running progress pod")
     print("Reading", join(dir_path, "pods_to_index.txt"))
     pod_urls = readPods(join(dir_path, "pods_to_index.txt"))
-    urls = []
-    for pod_url in pod_urls:
-        print(pod_url)
-        m = re.search('/([a-z]*)wiki',pod_url)
-        lang = m.group(1)
-        try:
-            local_dir = join(dir_path, "app", "static", "webmap", lang)
-            local_file = join(local_dir,pod_url.split('/')[-1].replace('?raw=true',''))
-            with open (local_file, "wb") as f:
-                f.write(requests.get(pod_url,allow_redirects=True).content)
-            print("Pod downloaded to",local_file)
-        except Exception:
-            print("Request failed when trying to index", pod_url, "...")
-
-        m, titles = joblib.load(local_file)
-        pod_entry = db.session.query(Pods).filter_by(url=pod_url).first()
-        print(m.shape,len(titles),titles[0])
-        for i in range(len(titles)):
-            title = titles[i]
-            url = 'https://'+lang+'.wikipedia.org/wiki/'+title.replace(' ','_') #Hack, URLs should of course be provided
-            vector = convert_to_string(m[i].toarray()[0])
-            print(vector)
-            if not db.session.query(Urls).filter_by(url=url).all():
-                u = Urls(
-                    url=url,
-                    title=title,
-                    snippet=title, #FIX
-                    pod=pod_url.split('/')[-1].replace('?raw=true',''), #FIX
-                    vector=vector,
-                    cc=True if 'wikipedia.org' in url else False)
-                urls.append(u)
-        pod_entry.registered = True
-        db.session.commit()
     def generate():
-        if len(urls) == 0:
-            print("All URLs already known.")
-            yield "data:" + "100" + "\n\n" 
-        else:
-            c = 0
-            for u in urls:
-                #print("Adding",u.url,"to DB")
-                try:
-                    db.session.add(u)
-                    db.session.commit()
-                    c += 1
-                except:
-                    print("Failed to add",u.url,"to DB...")
-                yield "data:" + str(int(c / len(urls) * 100)) + "\n\n"
-
+        for n, pod_url in enumerate(pod_urls):
+            print(pod_url)
+            m = re.search('/([a-z]*)wiki',pod_url)
+            lang = m.group(1)
+            pod_file = pod_url.split('/')[-1].replace('?raw=true','')
+            try:
+                local_dir = join(dir_path, "app", "static", "webmap", lang)
+                local_file = join(local_dir,pod_file)
+                with open (local_file, "wb") as f:
+                    f.write(requests.get(pod_url,allow_redirects=True).content)
+                print("Pod downloaded to",local_file)
+            except Exception:
+                print("Request failed when trying to index", pod_url, "...")
+
+            m, titles = joblib.load(local_file)
+            print(m.shape,len(titles),titles[0])
+            urls = ['https://'+lang+'.wikipedia.org/wiki/'+title.replace(' ','_') for title in titles] #Hack, URLs should of course be provided
+            pod_entry = db.session.query(Pods).filter_by(url=pod_url).first()
+            if pod_entry is None:
+                pod_entry = local_pod(pod_file, lang)
+            if not pod_entry.name:
+                pod_entry.name = pod_file
+            for inserted, total in import_pod(pod_entry, m, titles, urls):
+                done = n + (inserted / total if total else 1)
+                yield "data:" + str(min(99, int(done / len(pod_urls) * 100))) + "\n\n"
+        yield "data:" + "100" + "\n\n"
     return Response(generate(), mimetype='text/event-stream')
 
 
@@ -217,26 +165,32 @@ def progress_pods():
 
 @pod_finder.route('/unsubscribe/', methods=["POST"])
 def unsubscribe():
-    if request.form.getlist('pods') is not None:
-        unsubscribed_pods = request.form.getlist('pods')
-        lang = ''
-        for pod_name in unsubscribed_pods:
-            print("Unsubscribing pod...", pod_name)
-            pod_entries = db.session.query(Urls).filter_by(pod=pod_name).all()
-            if pod_entries is not None:
-                for e in pod_entries:
-                    db.session.delete(e)
-                    db.session.commit()
-            pod_entry = db.session.query(Pods).filter_by(name=pod_name).first()
-            print(pod_entry.language, pod_entry.url, pod_entry.registered)
-            lang = pod_entry.language
-            pod_entry.registered = False
-            db.session.commit()
-            print("Removing CSR matrix")
-            remove(join(pod_dir,pod_name+'.npz'))
-            print("Removing positional index")
-            remove(join(pod_dir,pod_name+'.pos'))
-            print("Reverting summary to 0")
-            pod_from_file(pod_name, lang, np.zeros(VEC_SIZE))
-    return render_template(
-        'pod_finder/unsubscribe-success.html', pods=unsubscribed_pods)
+    unsubscribed_pods = request.form.getlist('pods')
+    removal_id = start_pod_removal(unsubscribed_pods) #created now, so that a cancel can come before the progress stream starts
+    return render_template('pod_finder/progress_unsubscribe.html', pods=unsubscribed_pods, removal_id=removal_id)
+
+
+@pod_finder.route('/progress_unsubscribe')
+def progress_unsubscribe():
+    removal_id = request.args.get('removal')
+    pod_names = pods_to_remove(removal_id)
+    def generate():
+        try:
+            for i, pod_name in enumerate(pod_names):
+                print("Unsubscribing pod...", pod_name)
+                for status, num_deleted, total in remove_pod(pod_name, removal_id=removal_id):
+                    if status == CANCELLED:
+                        yield "data:" + "cancelled" + "\n\n"
+                        return
+                    done = i + (num_deleted / total if total else 1)
+                    yield "data:" + str(min(99, int(done / len(pod_names) * 100))) + "\n\n"
+            yield "data:" + "100" + "\n\n"
+        finally:
+            end_pod_removal(removal_id)
+    return Response(generate(), mimetype='text/event-stream')
+
+
+@pod_finder.route('/cancel_unsubscribe', methods=["POST"])
+def cancel_unsubscribe():
+    cancel_pod_removal(request.form.get('removal'))
+    return "Cancelling"
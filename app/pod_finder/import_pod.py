@@ -0,0 +1,79 @@
+# SPDX-FileCopyrightText: 2023 PeARS Project, <community@pearsproject.org>,
+#
+# SPDX-License-Identifier: AGPL-3.0-only
+
+'''Bulk import of downloaded pods.
+
+The CSR matrix of a pod file becomes the pod matrix as is, or is
+appended to it in one segment if the pod already exists. The Urls
+records only point to their row and are inserted INSERT_BATCH at a
+time. Rows of URLs that are already in the database are marked
+deleted instead. Pod files carry no positional index, so the imported
+rows are marked unindexed, and search always considers them. The pod
+is not compacted during the import, which would renumber its rows.'''
+
+import numpy as np
+from os.path import isfile
+from scipy.sparse import csr_matrix
+from app import db
+from app.api.models import Urls
+from app.indexer import pod_store, pod_summaries
+from app.indexer.posix import init_posix
+from app.search.pod_cache import invalidate_pod
+from app.utils_db import next_summary_row
+
+INSERT_BATCH = 10000 #Urls records inserted per transaction
+
+
+def summary_row(pod_entry):
+    '''Row of the pod in the summary matrix. Pods listed by the pod
+    finder carry their remote summary instead: they get a new row.'''
+    if not str(pod_entry.DS_vector).isdigit():
+        pod_entry.DS_vector = str(next_summary_row())
+    return int(pod_entry.DS_vector)
+
+
+def import_pod(pod_entry, m, titles, urls):
+    '''Add the documents of a downloaded pod (matrix m, with one row
+    per URL) to the pod of pod_entry, and register it. Yields (records
+    inserted, records to insert) after each batch.'''
+    with pod_store.writing(pod_entry.name):
+        yield from _import_pod(pod_entry, m, titles, urls)
+
+
+def _import_pod(pod_entry, m, titles, urls):
+    pod_name = pod_entry.name
+    m = csr_matrix(m)
+    known = set()
+    for i in range(0, len(urls), 500):
+        known.update(url for url, in db.session.query(Urls.url).filter(Urls.url.in_(urls[i:i+500])).all())
+    new = []
+    for i, url in enumerate(urls):
+        if url not in known:
+            known.add(url)
+            new.append(i)
+    print("Importing", len(new), "new URLs out of", len(urls), "into pod", pod_name)
+
+    if isfile(pod_store.base_path(pod_name)):
+        first_id = pod_store.append_rows(pod_name, m)
+    else:
+        pod_store.rewrite_pod(pod_name, m)
+        first_id = 0
+    pod_store.mark_unindexed(pod_name, first_id + np.asarray(new, dtype=np.int64))
+    if len(new) < len(urls):
+        pod_store.delete_rows(pod_name, first_id + np.setdiff1d(np.arange(len(urls)), new))
+    invalidate_pod(pod_name)
+    init_posix(pod_name)
+    pod_summaries.add_vectors(summary_row(pod_entry), m[new])
+    pod_summaries.flush()
+    pod_entry.registered = True
+    db.session.commit()
+
+    yield 0, len(new)
+    for start in range(0, len(new), INSERT_BATCH):
+        batch = new[start:start+INSERT_BATCH]
+        db.session.bulk_insert_mappings(Urls, [
+            {'url': urls[i], 'title': titles[i], 'snippet': titles[i], 'pod': pod_name, 'vector': str(first_id + i), 'row_id': first_id + i}
+            for i in batch])
+        db.session.commit()
+        yield start + len(batch), len(new)
@@ -4,8 +4,10 @@
 
 import re
 import string
+from functools import reduce
 from app import VEC_SIZE, vocab, inverted_vocab
 from app.indexer.posix import load_posix
+from app.indexer.pod_store import marked
 import numpy as np
 from scipy.spatial.distance import cdist
 
@@ -62,93 +64,110 @@ def completeness(v, m):
     completeness = 1 - cdist(v_nz, m_r, 'hamming')
     return completeness
 
-def posix_score_seq(posl, enforce_subwords=True):
-    # remove repeated words
-    posl = list(set(posl))
-
+def posix_score_docs(words, num_docs, enforce_subwords=True):
+    '''Positional score of many docs at once.
+    words has one tuple per (distinct) query word, holding for each
+    of the word's subword tokens a pair (doc_idx, positions) of flat
+    arrays: the token's positions in every doc, sorted by doc_idx
+    then position. Returns an array of num_docs scores.'''
     # only one subword word: perfect score
-    if len(posl) == 1 and len(posl[0]) == 1:
-        return 1.0
-    
-    scores = []
+    if len(words) == 1 and len(words[0]) == 1:
+        return np.ones(num_docs)
 
-    first_tok_pos = posl[0][0].split('|')  # first word -> first subword token -> split 'pos|pos|pos' to list 
-    prev_pos = [int(i) for i in first_tok_pos]
-
-    if enforce_subwords:
-        prev_subwords = prev_pos  # keep track of the positions of the previous subwords
-    else:
-        prev_subwords = None
-
-    for word_idx, word_posl in enumerate(posl): # loop over words
-        for p_idx, p_str in enumerate(word_posl):  # loop over subwords inside words
-            current_pos = [int(i) for i in p_str.split('|')]
-            if enforce_subwords:
-                if p_idx == 0:
-                    prev_subwords = current_pos  # first subword of a word: just get the positions, e.g. `_water` -> [19|55]
-                else:
-                    # non-initial subword, e.g. `melon` -> [53|56|99]
-                    conseq_subwords = []
-                    for p in current_pos:
-                        for prev_p in prev_subwords:  # compare distances: match 2nd `melon` instance (56-55 = 1), ignore the others 
-                            dist = p - prev_p
-                            if dist == 1:
-                                conseq_subwords.append(p)
-                                break
-                    if not conseq_subwords:  # none of the positions of current subword is consecutive
-                        scores.append(0.0)  # not the entire word is matched -> 0 score for this word
-                        break  # we can ignore the rest of the subwords
-                    prev_subwords = conseq_subwords
-
-                # if we made it to the last subword, it means the entire word was matched
-                if p_idx == len(word_posl) - 1:
-                    scores.append(1.0)  # assign a 1.0
-                    
-            else:
-                if word_idx == 0 and p_idx == 0:
-                    pass
-
-                pair_scores = _pair_score(prev_pos, current_pos)
-                #print("\nPAIR SCORES",scores)
-                if pair_scores:
-                    scores.extend(pair_scores)
-                else:
-                    scores.append(1.0)
-            prev_pos = current_pos
+    # encode (doc, position) as a single sortable key, leaving a gap between docs
+    stride = 2 + max([int(pos.max()) for word in words for _, pos in word if len(pos) > 0], default=0)
+    keys = [[doc_idx * stride + pos for doc_idx, pos in word] for word in words]
 
     if enforce_subwords:
-        return np.mean(scores)  # meaning: the fraction of words that were completely matched (= all subwords consecutive)
+        # fraction of words whose subwords all occur consecutively
+        matched_words = np.zeros(num_docs)
+        for word_keys in keys:
+            prev_subwords = word_keys[0]
+            for current in word_keys[1:]:
+                # keep subword positions directly preceded by the previous subword,
+                # e.g. `melon` at 56 after `_water` at 55
+                prev_subwords = current[np.isin(current - 1, prev_subwords)]
+            matched = np.zeros(num_docs, dtype=bool)
+            matched[prev_subwords // stride] = True
+            matched_words += matched
+        return matched_words / len(words)
     else:
-        return np.max(scores)  # meaning: 1.0 if there is at least one pair of tokens that is consecutive both in the query and in the document. Otherwise a fraction of this. 
+        # 1.0 if some pair of tokens consecutive in the query is also
+        # consecutive in the document, 1/distance for the closest pair otherwise
+        scores = np.zeros(num_docs)
+        tokens = [token_keys for word_keys in keys for token_keys in word_keys]
+        for prev_pos, current_pos in zip(tokens, tokens[1:]):
+            closest = np.searchsorted(prev_pos, current_pos) - 1  # last previous token position before each current one
+            valid = closest >= 0
+            valid[valid] = prev_pos[closest[valid]] // stride == current_pos[valid] // stride
+            min_dist = np.full(num_docs, np.inf)
+            np.minimum.at(min_dist, current_pos[valid] // stride, current_pos[valid] - prev_pos[closest[valid]])
+            scores = np.maximum(scores, np.where(np.isinf(min_dist), 1.0, 1 / min_dist))
+        return scores
 
-def posix(q, pod_name):
-    posindex = load_posix(pod_name)
-    print(q.split())
+def posix_score_seq(posl, enforce_subwords=True):
+    '''Positional score of a single doc. posl has one tuple per
+    query word, holding the sorted position array of each of the
+    word's subword tokens.'''
+    # remove repeated words
+    unique_words = {}
+    for word_posl in posl:
+        unique_words.setdefault(tuple(tuple(p) for p in word_posl), word_posl)
+    words = []
+    for word_posl in unique_words.values():
+        words.append(tuple((np.zeros(len(p), dtype=np.int64), np.asarray(p, dtype=np.int64)) for p in word_posl))
+    return float(posix_score_docs(words, 1, enforce_subwords)[0])
+
+def query_token_ids(q):
+    '''Vocabulary ids of the tokens in a tokenized query, minus unknown tokens.'''
     query_vocab_ids = [vocab.get(wp) for wp in q.split()]
     if any([i is None for i in query_vocab_ids]):
         print("WARNING: there were unknown tokens in the query")
         print(q.split(), query_vocab_ids)
         query_vocab_ids = [i for i in query_vocab_ids if i is not None]
+    return query_vocab_ids
+
+def candidate_docs(q, pod_name, min_candidates, posindex=None, deleted=None):
+    '''First retrieval stage: docs containing all query tokens or,
+    if there are fewer than min_candidates of those, docs containing
+    any query token. Docs sharing no token with the query have a
+    completeness of 0, so the fallback set loses no result. Docs
+    marked in the bitmap deleted are left out.'''
+    if posindex is None:
+        posindex = load_posix(pod_name)
+    query_vocab_ids = query_token_ids(q)
+    if not query_vocab_ids:
+        return []
+    docs = posindex.docs_with_all(query_vocab_ids)
+    if deleted is not None:
+        docs = docs[~marked(deleted, docs)]
+    if len(docs) < min_candidates:
+        docs = reduce(np.union1d, [posindex.docs(w) for w in set(query_vocab_ids)])
+        if deleted is not None:
+            docs = docs[~marked(deleted, docs)]
+    return docs.tolist()
+
+def posix(q, pod_name, posindex=None, deleted=None):
+    if posindex is None:
+        posindex = load_posix(pod_name)
+    print(q.split())
+    query_vocab_ids = query_token_ids(q)
+    if not query_vocab_ids:
+        return {}
+
+    matching_docs = posindex.docs_with_all(query_vocab_ids)   # only retain the docs that contain *all* tokens
+    if deleted is not None:
+        matching_docs = matching_docs[~marked(deleted, matching_docs)]
 
-    idx = []
+    words = []
     for w in query_vocab_ids:
-        idx.append(set(posindex[w].keys()))        # get docs containing token
-
-    matching_docs = list(set.intersection(*idx))   # intersect doc lists to only retain the docs that contain *all* tokens
-    doc_scores = {}
-    for doc in matching_docs:
-        positions = []
-        for w in query_vocab_ids:
-            token_str = inverted_vocab[w]
-            token_positions = posindex[w][doc]
-            #print("TOKEN STR",token_str)
-            if token_str.startswith("▁"):
-                positions.append((token_positions,))
-            else:
-                positions[-1] += (token_positions,)
-            #print("DOC",doc,"Q WORD", token_str, token_positions)
-
-        final_score = posix_score_seq(positions)
-        doc_scores[doc] = final_score
-        #print("\nFINAL SCORE FOR DOC", doc, final_score)
-    return doc_scores
+        token_str = inverted_vocab[w]
+        if token_str.startswith("▁") or not words:
+            words.append((w,))
+        else:
+            words[-1] += (w,)
+    words = list(dict.fromkeys(words))  # remove repeated words
+
+    token_positions = {w: posindex.positions_flat(w, matching_docs) for w in set(query_vocab_ids)}
+    scores = posix_score_docs([tuple(token_positions[w] for w in word) for word in words], len(matching_docs))
+    return dict(zip(matching_docs.tolist(), scores.tolist()))
@@ -0,0 +1,83 @@
+# SPDX-FileCopyrightText: 2023 PeARS Project, <community@pearsproject.org>,
+#
+# SPDX-License-Identifier: AGPL-3.0-only
+
+'''Process-wide cache of decoded pod matrices.
+Decompressing .npz files is the main query cost on
+large pods, so matrices are kept in memory and only
+reloaded when the pod store changes, or when the
+indexer explicitly invalidates them.'''
+
+import threading
+from app.indexer import pod_store
+from app.search.sparse_scoring import row_norms
+
+_cache = {}
+_bitmaps = {} #(name, kind) -> (file signature, bitmap)
+_lock = threading.Lock()
+
+
+def load_pod_matrix(name):
+    '''Return the CSR matrix of a pod, with all its segments.
+    The returned matrix is shared: do not modify it.'''
+    signature = pod_store.signature(name)
+    with _lock:
+        entry = _cache.get(name)
+        if entry is not None and entry['signature'] == signature:
+            return entry['matrix']
+    m = pod_store.load_pod(name)
+    with _lock:
+        _cache[name] = {'signature': signature, 'matrix': m}
+    return m
+
+
+def load_pod_with_norms(name):
+    '''Return the cached matrix for name together with its
+    row norms, computed once per version of the matrix.'''
+    m = load_pod_matrix(name)
+    with _lock:
+        entry = _cache.get(name)
+        if entry is not None and entry['matrix'] is m and 'norms' in entry:
+            return m, entry['norms']
+    norms = row_norms(m)
+    with _lock:
+        entry = _cache.get(name)
+        if entry is not None and entry['matrix'] is m:
+            entry['norms'] = norms
+    return m, norms
+
+
+def _load_bitmap(name, kind, signature, load):
+    with _lock:
+        entry = _bitmaps.get((name, kind))
+        if entry is not None and entry[0] == signature:
+            return entry[1]
+    bitmap = load(name)
+    with _lock:
+        _bitmaps[(name, kind)] = (signature, bitmap)
+    return bitmap
+
+
+def load_deleted_rows(name):
+    '''Return the bitmap of the deleted rows of a pod, reloaded
+    only when rows are deleted or the pod is compacted.'''
+    return _load_bitmap(name, 'deleted', pod_store.deleted_signature(name), pod_store.load_deleted)
+
+
+def load_unindexed_rows(name):
+    '''Return the bitmap of the rows of a pod that are not in its
+    positional index, reloaded only when it changes.'''
+    return _load_bitmap(name, 'unindexed', pod_store.unindexed_signature(name), pod_store.load_unindexed)
+
+
+def invalidate_pod(name=None):
+    '''Drop a pod from the cache, or everything if no name is given.
+    Called whenever a pod file is rewritten or removed.'''
+    with _lock:
+        if name is None:
+            _cache.clear()
+            _bitmaps.clear()
+        else:
+            _cache.pop(name, None)
+            _bitmaps.pop((name, 'deleted'), None)
+            _bitmaps.pop((name, 'unindexed'), None)
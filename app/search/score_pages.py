@@ -9,16 +9,21 @@ import re
 import math
 from pandas import read_csv
 from app.api.models import Urls, Pods
-from app import db, VEC_SIZE
+from app import db, VEC_SIZE, TWO_STAGE_RETRIEVAL
 from app.utils_db import (
-    get_db_url_snippet, get_db_url_title, get_db_url_doctype, get_db_url_pod, get_db_url_notes)
+    get_db_url_snippet, get_db_url_title, get_db_url_doctype, get_db_url_pod, get_db_url_notes,
+    get_db_urls, get_db_pod_urls)
 
-from .overlap_calculation import score_url_overlap, generic_overlap, completeness, posix
+from .overlap_calculation import score_url_overlap, generic_overlap, posix, candidate_docs
 from app.search import term_cosine
+from app.search.pod_cache import load_pod_matrix, load_pod_with_norms, load_deleted_rows, load_unindexed_rows
+from app.indexer.pod_store import marked
+from app.search.sparse_scoring import cosines, completeness
 from app.utils import cosine_similarity, hamming_similarity, convert_to_array, parse_query
 from app.indexer.mk_page_vector import compute_query_vectors
-from scipy.sparse import csr_matrix, load_npz
-from scipy.spatial import distance
+from app.indexer.posix import load_posix
+from app.indexer import pod_summaries
+from scipy.sparse import csr_matrix
 from os.path import dirname, join, realpath, isfile
 import numpy as np
 
@@ -26,18 +31,22 @@ dir_path = dirname(dirname(realpath(__file__)))
 pod_dir = join(dir_path,'static','pods')
 raw_dir = join(dir_path,'static','toindex')
 
+# In two-stage retrieval, docs containing all query tokens are
+# the only candidates, unless there are fewer than this many.
+MIN_CANDIDATES = 50
+
 
 def score_experts(doc_idx,kwd):
     DS_scores = {}
-    query_pod_m = load_npz(join(pod_dir,kwd+'.npz'))
-    query_vec = query_pod_m[int(doc_idx)].todense().reshape(1,VEC_SIZE)
-    ind_pod_m = load_npz(join(pod_dir,'Individuals.npz'))
-    m_cosines = 1 - distance.cdist(query_vec, ind_pod_m.todense(), 'cosine')
+    query_pod_m = load_pod_matrix(kwd)
+    query_vec = query_pod_m[int(doc_idx)].toarray()
+    ind_pod_m, ind_norms = load_pod_with_norms('Individuals')
+    m_cosines = cosines(query_vec, ind_pod_m, ind_norms)
     
     for u in db.session.query(Urls).filter_by(pod='Individuals').all():
-        score = m_cosines[0][int(u.vector)]
+        score = m_cosines[0][u.row_id]
         if score >= 0.05:
-            DS_scores[u.url] = m_cosines[0][int(u.vector)]
+            DS_scores[u.url] = m_cosines[0][u.row_id]
             print("EXPERT",u.url,score)
     urls = bestURLs(DS_scores)
     return output(urls, 'ind')
@@ -47,27 +56,47 @@ def score(query, query_dist, tokenized, kwd):
     snippet_scores = {}
     DS_scores = {}
     completeness_scores = {}
-    posix_scores = posix(tokenized, kwd)
+    vector_ids = {}
+    posindex = load_posix(kwd)
+    deleted = load_deleted_rows(kwd)
+    posix_scores = posix(tokenized, kwd, posindex, deleted)
 
-    pod_m = load_npz(join(pod_dir,kwd+'.npz'))
-    m_cosines = 1 - distance.cdist(query_dist, pod_m.todense(), 'cosine')
-    m_completeness = completeness(query_dist, pod_m.todense())
+    pod_m, norms = load_pod_with_norms(kwd)
+    if TWO_STAGE_RETRIEVAL:
+        '''Only rerank the docs found in the positional index,
+        and those imported without positional index'''
+        rows = candidate_docs(tokenized, kwd, MIN_CANDIDATES, posindex, deleted)
+        unindexed = np.flatnonzero(load_unindexed_rows(kwd))
+        if len(unindexed):
+            unindexed = unindexed[(unindexed < pod_m.shape[0]) & ~marked(deleted, unindexed)]
+            rows = np.union1d(rows, unindexed).astype(np.int64).tolist()
+        print("CANDIDATES",len(rows),"/",pod_m.shape[0])
+        pod_m, norms = pod_m[rows], norms[rows]
+        urls = get_db_pod_urls(kwd, rows)
+        row_pos = {row: i for i, row in enumerate(rows)}
+    else:
+        urls = db.session.query(Urls).filter_by(pod=kwd).all()
+        row_pos = None
+    m_cosines = cosines(query_dist, pod_m, norms)
+    m_completeness = completeness(query_dist, pod_m)
 
-    for u in db.session.query(Urls).filter_by(pod=kwd).all():
-        DS_scores[u.url] = m_cosines[0][int(u.vector)]
-        completeness_scores[u.url] = m_completeness[0][int(u.vector)]
+    for u in urls:
+        vector_ids[u.url] = u.row_id
+        i = u.row_id if row_pos is None else row_pos[u.row_id]
+        DS_scores[u.url] = m_cosines[0][i]
+        completeness_scores[u.url] = m_completeness[0][i]
         #URL_scores[u.url] = score_url_overlap(query, u.url)
         snippet_scores[u.url] = generic_overlap(query, u.title+' '+u.snippet)
         #print("SNIPPET SCORE",u.url,snippet_scores[u.url])
-    return DS_scores, completeness_scores, snippet_scores, posix_scores
+    return DS_scores, completeness_scores, snippet_scores, posix_scores, vector_ids
 
 
 def score_pods(query, query_dist, lang):
     '''Score pods for a query'''
     pod_scores = {}
     score_sum = 0.0
-    podsum = load_npz(join(pod_dir,'podsum.npz'))
-    m_cosines = 1 - distance.cdist(query_dist, podsum.todense(), 'cosine')
+    podsum, podsum_norms = pod_summaries.routing_matrix()
+    m_cosines = cosines(query_dist, podsum, podsum_norms)
 
     pods = db.session.query(Pods).filter_by(language=lang).filter_by(registered=True).all()
     for p in pods:
@@ -96,11 +125,11 @@ def score_pods(query, query_dist, lang):
 def score_docs(query, query_dist, tokenized, kwd):
     '''Score documents for a query'''
     document_scores = {}  # Document scores
-    DS_scores, completeness_scores, snippet_scores, posix_scores = score(query, query_dist, tokenized, kwd)
+    DS_scores, completeness_scores, snippet_scores, posix_scores, vector_ids = score(query, query_dist, tokenized, kwd)
     print("POSIX SCORES",posix_scores)
     for url in list(DS_scores.keys()):
         document_scores[url] = 0.0
-        idx = db.session.query(Urls).filter_by(url=url).first().vector
+        idx = int(vector_ids[url])
         if idx in posix_scores:
             document_scores[url]+=posix_scores[idx]
         document_scores[url]+=completeness_scores[url]
@@ -191,9 +220,10 @@ def output(best_urls, doctype):
     if len(best_urls) == 0:
         return results, pods
     urls, csvs = aggregate_csv(best_urls)
+    recs = get_db_urls(urls + [csv[1] for csv in csvs])
 
     for csv in csvs:
-        rec = Urls.query.filter(Urls.url == csv[1]).first()
+        rec = recs[csv[1]]
         if doctype != None and rec.doctype != doctype:
             continue
         result = {}
@@ -209,7 +239,7 @@ def output(best_urls, doctype):
         results.append(result)
 
     for u in urls:
-        rec = Urls.query.filter(Urls.url == u).first()
+        rec = recs[u]
         if doctype != None and rec.doctype != doctype:
             continue
         result = {}
@@ -0,0 +1,43 @@
+# SPDX-FileCopyrightText: 2023 PeARS Project, <community@pearsproject.org>,
+#
+# SPDX-License-Identifier: AGPL-3.0-only
+
+'''Scoring functions working directly on CSR pod matrices.
+They return the same values as cdist(..., 'cosine') and
+overlap_calculation.completeness on the densified matrix,
+without ever materialising the N x VEC_SIZE dense array.'''
+
+import numpy as np
+
+
+def row_norms(m):
+    '''L2 norm of each row of a sparse matrix.'''
+    return np.sqrt(np.asarray(m.multiply(m).sum(axis=1)).ravel())
+
+
+def cosines(query_vec, m, norms=None):
+    '''Cosine between a dense 1 x VEC_SIZE query and each row of m.
+    Zero rows (or a zero query) give NaN, as cdist does.'''
+    q = np.asarray(query_vec, dtype=np.float64).ravel()
+    if norms is None:
+        norms = row_norms(m)
+    dots = m.dot(q)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        cos = dots / (norms * np.linalg.norm(q))
+    return cos.reshape(1, -1)
+
+
+def completeness(query_vec, m):
+    '''Proportion of the query's nonzero dimensions on which each row
+    of m agrees with the query (both positive, or both not positive).'''
+    q = np.asarray(query_vec).ravel()
+    idx = np.flatnonzero(q)
+    numcols = idx.shape[0]
+    if numcols == 0:
+        return np.full((1, m.shape[0]), np.nan)
+    q_bin = (q[idx] > 0).astype(np.float64)
+    m_bin = (m[:, idx] > 0).astype(np.float64)
+    hits = m_bin.dot(q_bin)
+    row_counts = np.asarray(m_bin.sum(axis=1)).ravel()
+    agreements = hits + (numcols - q_bin.sum()) - (row_counts - hits)
+    return (agreements / numcols).reshape(1, -1)
@@ -16,6 +16,8 @@ from scipy.sparse import csr_matrix, save_npz
 from os.path import dirname, join, realpath, isfile
 from pathlib import Path
 from app import VEC_SIZE, LANG, vocab
+from app.indexer.posix import init_posix
+from app.indexer import pod_summaries
 
 dir_path = dirname(realpath(__file__))
 
@@ -120,21 +122,15 @@ def init_pod(pod_name):
         pod = np.zeros((1,VEC_SIZE))
         pod = csr_matrix(pod)
         save_npz(join(pod_dir,pod_name+'.npz'), pod)
-    
-    if not isfile(join(pod_dir,pod_name+'.pos')):
-        print("Making empty positional index for new pod")
-        posindex = [{} for _ in range(len(vocab))]
-        joblib.dump(posindex, join(pod_dir,pod_name+'.pos'))
+    init_posix(pod_name)
 
 def init_podsum():
     dir_path = dirname(dirname(realpath(__file__)))
     pod_dir = join(dir_path,'app','static','pods')
     Path(pod_dir).mkdir(exist_ok=True, parents=True)
-    print("Making 0 CSR matrix for pod summaries")
+    print("Making empty matrix for pod summaries")
     print("POD DIR",pod_dir)
-    pod_summaries = np.zeros((1,VEC_SIZE))
-    pod_summaries = csr_matrix(pod_summaries)
-    save_npz(join(pod_dir,"podsum.npz"), pod_summaries)
+    pod_summaries.reset()
 
 
 def normalise(v):
@@ -8,9 +8,9 @@ from app.api.models import Urls, Pods
 from app.api.models import installed_languages
 from app.utils import convert_to_array, convert_string_to_dict, convert_to_string, normalise
 from app.indexer.mk_page_vector import compute_query_vectors
+from app.indexer import pod_summaries
 import numpy as np
 from os.path import dirname, realpath, join
-from scipy.sparse import csr_matrix, vstack, save_npz, load_npz
 
 dir_path = dirname(dirname(realpath(__file__)))
 pod_dir = join(dir_path,'app','static','pods')
@@ -40,6 +40,27 @@ def get_db_url_notes(url):
     return url_notes
 
 
+def get_db_urls(urls, batch_size=500):
+    '''Fetch the Urls rows for a list of URLs with one IN query
+    per batch (SQLite limits the number of bound parameters).
+    Returns a dictionary url -> row.'''
+    rows = {}
+    urls = list(set(urls))
+    for i in range(0, len(urls), batch_size):
+        for u in Urls.query.filter(Urls.url.in_(urls[i:i+batch_size])).all():
+            rows[u.url] = u
+    return rows
+
+
+def get_db_pod_urls(pod, row_ids, batch_size=500):
+    '''Fetch the Urls rows of a pod whose row ids are in row_ids.'''
+    rows = []
+    row_ids = [int(i) for i in row_ids]
+    for i in range(0, len(row_ids), batch_size):
+        rows.extend(Urls.query.filter(Urls.pod == pod).filter(Urls.row_id.in_(row_ids[i:i+batch_size])).all())
+    return rows
+
+
 def get_db_pod_name(url):
     pod_name = Pods.query.filter(Pods.url == url).first().name
     return pod_name
@@ -102,7 +123,15 @@ def pod_from_json(pod, url):
     db.session.commit()
 
 
-def pod_from_file(name, lang, podsum):
+def next_summary_row():
+    '''Free row of the pod summary matrix, for a new pod. Pods listed by
+    the pod finder carry their remote summary in DS_vector, not a row.'''
+    rows = [int(v) for v, in db.session.query(Pods.DS_vector).all() if str(v).isdigit()]
+    return max(rows, default=-1) + 1
+
+
+def local_pod(name, lang):
+    '''Pods entry of a local pod, created on first use.'''
     # TODO: pods can't be named any old thing,
     # if they're going to be in localhost URLs
     url = "http://localhost:8080/api/pods/" + name.replace(' ', '+')
@@ -112,24 +141,34 @@ def pod_from_file(name, lang, podsum):
         p.description = name
         p.language = lang
         p.registered = True
-        p.DS_vector = str(len(db.session.query(Pods).all()))
+        p.DS_vector = str(next_summary_row())
         db.session.add(p)
         db.session.commit()
-    print("UPDATING SUMMARY POD")
-    p = db.session.query(Pods).filter_by(url=url).first()
-    print(podsum)
-    print(np.sum(podsum))
-    if np.sum(podsum) != 0: # check necessary for cases where pod has been deleted before
-        p.registered = True
-    p_idx = int(p.DS_vector)
-    pod_m = load_npz(join(pod_dir,'podsum.npz'))
-    print("--- current shape",pod_m.shape)
-    if pod_m.shape[0] >= p_idx + 1:
-        pod_m[p_idx] = podsum
-    else:
-        pod_m = vstack((pod_m, csr_matrix(podsum)))
-    print("--- new shape",pod_m.shape)
-    save_npz(join(pod_dir,'podsum.npz'),pod_m)
+    return db.session.query(Pods).filter_by(url=url).first()
+
+
+def pod_from_file(name, lang, podsum=None, count=0):
+    '''Register a local pod and, if podsum is given, overwrite its summary.'''
+    p = local_pod(name, lang)
+    if podsum is not None:
+        print("UPDATING SUMMARY POD")
+        if np.sum(podsum) != 0: # check necessary for cases where pod has been deleted before
+            p.registered = True
+        pod_summaries.set_summary(int(p.DS_vector), podsum, count)
     db.session.commit()
 
 
+def add_to_pod_summary(name, lang, vectors):
+    '''Add newly indexed document vectors to the summary of a local pod.'''
+    p = local_pod(name, lang)
+    p.registered = True
+    pod_summaries.add_vectors(int(p.DS_vector), vectors)
+    db.session.commit()
+
+
+def remove_from_pod_summary(name, vectors):
+    '''Subtract the vectors of deleted documents from the summary of a pod.'''
+    p = db.session.query(Pods).filter_by(name=name).first()
+    pod_summaries.remove_vectors(int(p.DS_vector), vectors)
+
+
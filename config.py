@@ -15,6 +15,17 @@ BASE_DIR = os.path.abspath(os.path.dirname(__file__))
 SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(BASE_DIR, 'app.db')
 DATABASE_CONNECT_OPTIONS = {}
 
+# Pragmas set on every new SQLite connection. In WAL mode, searches
+# keep reading while the indexer writes, and synchronous=NORMAL only
+# syncs at checkpoints (a crash can lose the last commits, not corrupt
+# the database). mmap_size is in bytes, a negative cache_size in KiB.
+SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'mmap_size': 268435456,
+    'cache_size': -65536,
+}
+
 # Application threads. A common general assumption is
 # using 2 per available processor cores - to handle
 # incoming requests using one and performing background
@@ -0,0 +1,20 @@
+# SPDX-FileCopyrightText: 2023 PeARS Project, <community@pearsproject.org> 
+#
+# SPDX-License-Identifier: AGPL-3.0-only
+
+# Convert the positional indices of existing pods (.pos files)
+# to the compact .posx format. Pods are also migrated lazily
+# the first time they are searched, so this is optional.
+
+import sys
+
+if len(sys.argv) != 2:
+    print("Please give the default language of your installation, as for run.py. \nEXAMPLE USAGE: python3 migrate_posix.py en")
+    sys.exit()
+
+from glob import glob
+from os.path import basename, join
+from app.indexer.posix import posix_dir, migrate_posix
+
+for pos_file in sorted(glob(join(posix_dir,'*.pos'))):
+    migrate_posix(basename(pos_file)[:-4])
@@ -0,0 +1,30 @@
+# SPDX-FileCopyrightText: 2023 PeARS Project, <community@pearsproject.org>,
+#
+# SPDX-License-Identifier: AGPL-3.0-only
+
+'''Initializer of the parsing processes of app/indexer/parse_pool.py.
+
+Importing the app package sets up the whole application (Flask, the
+vocabulary, the database and its migration), which parsing processes
+must not do. This module therefore lives outside the package, and
+init_worker registers a bare app package instead, then fills in the
+parser settings that app/__init__.py would have.'''
+
+import sys
+import types
+from os.path import dirname, join, realpath
+from langdetect.detector_factory import init_factory
+
+
+def init_worker(*settings):
+    '''Set up a parsing process with the parser settings of the server
+    process (see app/indexer/parser_settings.py).'''
+    if 'app' not in sys.modules:
+        package = types.ModuleType('app')
+        package.__path__ = [join(dirname(realpath(__file__)), 'app')]
+        sys.modules['app'] = package
+        from app.indexer import parser_settings
+        parser_settings.configure(*settings)
+    from app.indexer import parser_settings
+    assert parser_settings.current() == settings, "Parser settings differ from the server's"
+    init_factory()
@@ -0,0 +1,36 @@
+# SPDX-FileCopyrightText: 2023 PeARS Project, <community@pearsproject.org> 
+#
+# SPDX-License-Identifier: AGPL-3.0-only
+
+# Fetch the indexed web pages again and re-index those that changed,
+# e.g. every night from cron. Unchanged pages cost a conditional
+# request (or a download and a hash) and are not re-vectorized.
+#
+# The refresh is run by the pear itself, which must be running: it owns
+# the pods and their summaries, and another process writing them at
+# the same time would undo its changes. Set PEARS_URL if it does not
+# listen on the address of run.py.
+
+import os
+import sys
+import requests
+
+PEARS_URL = os.environ.get("PEARS_URL", "http://localhost:8080")
+
+if __name__ == '__main__':
+    if len(sys.argv) not in (2, 3):
+        print("Please give the default language of your installation, as for run.py, and optionally the pod to refresh. \nEXAMPLE USAGE: python3 refresh.py en [pod]")
+        sys.exit()
+
+    pod = sys.argv[2] if len(sys.argv) == 3 else ''
+    try:
+        requests.post(PEARS_URL + "/indexer/from_refresh", data={'refresh_keyword': pod}).raise_for_status()
+        progress = requests.get(PEARS_URL + "/indexer/progress_refresh", stream=True)
+        progress.raise_for_status()
+    except requests.ConnectionError:
+        print("No pear is running at", PEARS_URL, "- please start it with run.py, or set PEARS_URL.")
+        sys.exit(1)
+    for line in progress.iter_lines(decode_unicode=True):
+        if line.startswith("data:"):
+            print("Refreshed", line[5:].strip() + "% of the pages")
+    print("Finished. The pear's log lists the pages refreshed.")
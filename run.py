@@ -4,7 +4,6 @@
 
 # Run a test server.
 
-from app import app
-
 if __name__ == '__main__':
+    from app import app
     app.run(host='0.0.0.0', port=8080, debug=True)